@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+## This script measures how the creation of the space, the walk, the plot and
+## the gif scale with the number of quaternions, the neighbour and the length of
+## the walk. The results are saved in a json file, and can be compared with the
+## results of a previous run to detect the regressions.
+##
+##     python benchmark.py --output results.json --baseline baseline.json
+
+import argparse, itertools, json, os, platform, sys, tempfile, time, tracemalloc
+import numpy as np
+from creating_space import Space
+from quaternion_index import QuaternionIndex
+from space_cache import SpaceCache
+from instrumentation import Instrumentation
+
+
+def measuring(function):
+    """
+    Runs function twice: once to measure its duration, then once with tracemalloc
+    to measure the peak of memory allocated. Returns the duration, the peak in
+    bytes and the value returned by the first run.
+    """
+    tic = time.perf_counter()
+    value = function()
+    seconds = time.perf_counter() - tic
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak, value
+
+
+def timing_steps(steps):
+    """
+    Returns the duration of every step of an iterator, in seconds.
+    """
+    latencies = []
+    tic = time.perf_counter()
+    for _ in steps:
+        toc = time.perf_counter()
+        latencies.append(toc - tic)
+        tic = toc
+    return np.array(latencies)
+
+
+def percentiles(latencies):
+    """
+    Returns the percentiles of the durations of the steps, in seconds.
+    """
+    return {"p50": float(np.percentile(latencies, 50)),
+            "p90": float(np.percentile(latencies, 90)),
+            "p99": float(np.percentile(latencies, 99)),
+            "max": float(latencies.max())}
+
+
+def benchmarking_space(sizes, list_limit):
+    """
+    Yields the results of the creation of spaces of every size.
+    """
+    for size, generator in itertools.product(sizes, ["random", "super_fibonacci", "halton"]):
+        seconds, peak, _ = measuring(lambda: Space(size, 0, seed=0).create_space(generator))
+        yield {"name": "create_space", "params": {"nb_quaternions": size, "generator": generator},
+               "seconds": seconds, "peak_bytes": peak}
+    with tempfile.TemporaryDirectory() as folder:
+        cache = SpaceCache(folder)
+        previous = None
+        for size in sorted(sizes):
+            if previous is None:
+                cache.load("random", 0, size)
+            else:
+                # the space of the previous size is grown, instead of being created again
+                space_array = cache.load("random", 0, previous)
+                seconds, peak, _ = measuring(lambda: cache.grow(space_array, "random", 0, size))
+                yield {"name": "SpaceCache.grow", "params": {"nb_quaternions": size, "from": previous},
+                       "seconds": seconds, "peak_bytes": peak}
+            previous = size
+            seconds, peak, _ = measuring(lambda: cache.load("random", 0, size))
+            yield {"name": "SpaceCache.load", "params": {"nb_quaternions": size},
+                   "seconds": seconds, "peak_bytes": peak}
+    for size in sizes:
+        if size > list_limit:
+            continue
+        # the original function scans the list for duplicates, in O(n²)
+        seconds, peak, _ = measuring(lambda: Space(size, 0).create_space_distribution())
+        yield {"name": "create_space_distribution", "params": {"nb_quaternions": size},
+               "seconds": seconds, "peak_bytes": peak}
+
+
+def benchmarking_walk(sizes, neighbours, walk_lengths, list_limit):
+    """
+    Yields the results of the walks through spaces of every size, with the scan
+    of the whole space and with the index, and of the original list-based step.
+    """
+    for size in sizes:
+        space_array = Space(size, 0, seed=0).create_space()
+        seconds, peak, index = measuring(lambda: QuaternionIndex(space_array))
+        yield {"name": "QuaternionIndex", "params": {"nb_quaternions": size},
+               "seconds": seconds, "peak_bytes": peak}
+        for neighbour, steps, use_index in itertools.product(neighbours, walk_lengths, [False, True]):
+            walking = lambda: timing_steps(Space(size, neighbour, seed=0).iter_walk(
+                space_array, steps, index if use_index else None))
+            seconds, peak, latencies = measuring(walking)
+            yield {"name": "iter_walk",
+                   "params": {"nb_quaternions": size, "neighbour": neighbour,
+                              "steps": steps, "use_index": use_index},
+                   "seconds": seconds, "peak_bytes": peak, "latency": percentiles(latencies)}
+        for neighbour, steps in itertools.product(neighbours, walk_lengths):
+            # cost of the measures of the walk, kept in memory
+            walking = lambda: timing_steps(Space(size, neighbour, seed=0, instrument=Instrumentation())
+                                           .iter_walk(space_array, steps))
+            seconds, peak, latencies = measuring(walking)
+            yield {"name": "iter_walk_instrumented",
+                   "params": {"nb_quaternions": size, "neighbour": neighbour, "steps": steps},
+                   "seconds": seconds, "peak_bytes": peak, "latency": percentiles(latencies)}
+        if size > list_limit:
+            continue
+        space = Space(size, 2, seed=0)
+        space_list = list(space.create_space_distribution_batch())
+        seconds, peak, _ = measuring(lambda: space.find_next_quaternion(
+            space.q0, space_list, space.q0, first=True))
+        yield {"name": "find_next_quaternion", "params": {"nb_quaternions": size},
+               "seconds": seconds, "peak_bytes": peak}
+
+
+def benchmarking_explore(sizes, folder):
+    """
+    Yields the results of explore_space(), which walks 10001 steps.
+    """
+    for size in sizes:
+        space = Space(size, 2, seed=0)
+        space_array = space.create_space()
+        filepath = os.path.join(folder, "rotations.csv")
+        seconds, peak, _ = measuring(lambda: space.explore_space(space_array, filepath=filepath))
+        yield {"name": "explore_space", "params": {"nb_quaternions": size},
+               "seconds": seconds, "peak_bytes": peak}
+
+
+def benchmarking_images(sizes, nb_frames, folder):
+    """
+    Yields the results of plot_hypersphere() and create_gif().
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    from PIL import Image
+    for size in sizes:
+        space = Space(size, 0, seed=0)
+        space_list = space.create_space_distribution_batch()
+        current = os.getcwd()
+        os.chdir(folder)
+        try:
+            seconds, peak, _ = measuring(lambda: space.plot_hypersphere(space_list))
+        finally:
+            os.chdir(current)
+        yield {"name": "plot_hypersphere", "params": {"nb_quaternions": size},
+               "seconds": seconds, "peak_bytes": peak}
+    frames = os.path.join(folder, "frames/")
+    os.makedirs(frames, exist_ok=True)
+    for i in range(nb_frames):
+        Image.new("RGB", (128, 128), (i % 256, 0, 0)).save(frames + "frame_{}.png".format(i))
+    seconds, peak, _ = measuring(lambda: Space(0, 0).create_gif(frames, os.path.join(folder, "bench")))
+    yield {"name": "create_gif", "params": {"nb_frames": nb_frames},
+           "seconds": seconds, "peak_bytes": peak}
+
+
+def comparing(results, baseline, tolerance):
+    """
+    Returns the results which are slower than in the baseline by more than
+    tolerance (0.2 for 20%), with their duration in the baseline.
+    """
+    def key(result):
+        return result["name"], json.dumps(result["params"], sort_keys=True)
+    previous = {key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results["results"]:
+        before = previous.get(key(result))
+        if before is not None and result["seconds"] > before["seconds"] * (1 + tolerance):
+            regressions.append(dict(result, baseline_seconds=before["seconds"]))
+    return regressions
+
+
+def running(args):
+    """
+    Runs every benchmark selected by the arguments and returns the results.
+    """
+    results = {"python": sys.version.split()[0], "numpy": np.__version__,
+               "platform": platform.platform(), "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+               "results": []}
+    with tempfile.TemporaryDirectory() as folder:
+        benchmarks = [benchmarking_space(args.sizes, args.list_limit),
+                      benchmarking_walk(args.sizes, args.neighbours, args.steps, args.list_limit),
+                      benchmarking_explore([size for size in args.sizes if size <= args.explore_limit],
+                                           folder)]
+        if not args.no_images:
+            benchmarks.append(benchmarking_images(
+                [size for size in args.sizes if size <= args.plot_limit], args.frames, folder))
+        for result in itertools.chain(*benchmarks):
+            print("{:<26} {:<70} {:9.3f} s {:10.1f} MB".format(
+                result["name"], json.dumps(result["params"]), result["seconds"],
+                result["peak_bytes"] / 1e6))
+            results["results"].append(result)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks of the space generation and of the walk")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000],
+                        help="numbers of quaternions of the spaces")
+    parser.add_argument("--neighbours", type=int, nargs="+", default=[1, 2, 5])
+    parser.add_argument("--steps", type=int, nargs="+", default=[100, 1000],
+                        help="lengths of the walks")
+    parser.add_argument("--list-limit", type=int, default=10000,
+                        help="greatest size given to the list-based functions")
+    parser.add_argument("--explore-limit", type=int, default=100000,
+                        help="greatest size given to explore_space")
+    parser.add_argument("--plot-limit", type=int, default=10000,
+                        help="greatest size given to plot_hypersphere")
+    parser.add_argument("--frames", type=int, default=200, help="number of frames of the gif")
+    parser.add_argument("--no-images", action="store_true", help="skips the plot and the gif")
+    parser.add_argument("--quick", action="store_true", help="small grid for a quick check")
+    parser.add_argument("--output", default="benchmark.json", help="json file of the results")
+    parser.add_argument("--baseline", default=None, help="json file of previous results")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="slowdown above which a result is a regression")
+    args = parser.parse_args()
+    if args.quick:
+        args.sizes, args.neighbours, args.steps = [1000, 10000], [2], [100]
+        args.frames = 20
+    results = running(args)
+    with open(args.output, "w") as outputfile:
+        json.dump(results, outputfile, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as inputfile:
+            regressions = comparing(results, json.load(inputfile), args.tolerance)
+        for regression in regressions:
+            print("Regression: {} {} {:.3f} s instead of {:.3f} s".format(
+                regression["name"], json.dumps(regression["params"]),
+                regression["seconds"], regression["baseline_seconds"]))
+        sys.exit(1 if regressions else 0)
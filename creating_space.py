@@ -4,14 +4,24 @@
 # JOUFFROY Emma intern 2020
 ####
 
+import time
+# time at which the import of this module began, reported by main()
+IMPORT_START = time.perf_counter()
+
+# matplotlib and PIL are only imported by plot_hypersphere() and create_gif(),
+# so that the space and the rotations can be created on nodes without display
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import animation, colors
-from mpl_toolkits.mplot3d import Axes3D
-from PIL import Image
-import csv, glob, random, quaternion, collections, copy
-import matplotlib.cm as cmx
-import matplotlib.patches as mpatches
+import argparse, csv, glob, io, math, os, random, re, sys, zipfile, quaternion, collections
+import concurrent.futures
+from rotations_io import RotationsWriter, save_rotations
+from quaternion_index import QuaternionIndex
+from quaternion_kernels import geodesic_angle, multiply, norm_distance, relative_transform
+from instrumentation import Instrumentation
+
+
+# summary of a walk through every quaternion of a space
+TourReport = collections.namedtuple("TourReport", ["coverage", "path_length",
+                                                   "worst_step", "worst_angle"])
 
 
 class Space():
@@ -21,14 +31,24 @@ class Space():
     that allow us to span the sphere. 
     """
 
-    def __init__(self, nb_quaternions, neighbour):
+    def __init__(self, nb_quaternions, neighbour, seed=None, instrument=None):
         """
         nb quaternions : number of quaternions in the space created
         neighbour : number from wich a quaternion can be chosen from the minimal distance
+        seed : seed (or numpy SeedSequence/Generator) of the generator used by the
+        batched functions
+        instrument : Instrumentation receiving the measures of the walks, None
+        to measure nothing
         """
         self.nb_quaternions = nb_quaternions
         self.neighbour = neighbour
         self.q0 = np.quaternion(1,0,0,0)
+        self.rng = np.random.default_rng(seed)
+        self.instrument = instrument
+        # quaternions accepted in the last block of couples drawn, the first
+        # block_used of them being already returned, and state of the generator
+        # before this block
+        self.block, self.block_used, self.block_state = np.empty((0, 4)), 0, None
 
     def creating_couples(self):
         """
@@ -48,7 +68,7 @@ class Space():
         the function creatings_couples()
         """
         x1, x2, x3, x4 = self.creating_couples()
-        sqrt_quat = np.math.sqrt((1-(x1*x1)-(x2*x2))/((x3*x3)+(x4*x4)))
+        sqrt_quat = np.sqrt((1-(x1*x1)-(x2*x2))/((x3*x3)+(x4*x4)))
         x, y, z, w = x1, x2, x3 * sqrt_quat, x4 * sqrt_quat
         quaternion = np.quaternion(x,y,z,w)
         return quaternion
@@ -66,6 +86,220 @@ class Space():
             quaternions_space.append(quaternion)
         return quaternions_space
 
+    def drawing_block(self, block_size=65536):
+        """
+        Draws a block of block_size couples with the method of Marsaglia (1972),
+        and keeps the quaternions of the couples accepted (with a probability of
+        (pi/4)² ~ 0.62) in self.block.
+        """
+        self.block_state = self.rng.bit_generator.state
+        couples = self.rng.uniform(-1, 1, (block_size, 4))
+        s1 = couples[:, 0]**2 + couples[:, 1]**2
+        s2 = couples[:, 2]**2 + couples[:, 3]**2
+        keep = (s1 < 1) & (s2 < 1) & (s2 > 0)
+        couples, s1, s2 = couples[keep], s1[keep], s2[keep]
+        couples[:, 2:] *= np.sqrt((1 - s1) / s2)[:, np.newaxis]
+        self.block, self.block_used = couples, 0
+
+    def creating_quaternions_array(self, size):
+        """
+        Returns an array of shape (size, 4) of quaternions drawn with the method
+        of Marsaglia (1972), the couples being drawn and rejected by blocks of a
+        fixed size instead of one at a time. The quaternions of a block not
+        returned are kept for the next call, so that the quaternions drawn do
+        not depend on the sizes asked: two calls of sizes a and b return the
+        quaternions of one call of size a + b. The columns follow the order of
+        the quaternions returned by creating_quaternion().
+
+        size: number of quaternions to draw
+        """
+        quaternions = np.empty((size, 4))
+        filled = 0
+        while filled < size:
+            if self.block_used == len(self.block):
+                self.drawing_block()
+            nb_kept = min(len(self.block) - self.block_used, size - filled)
+            quaternions[filled:filled + nb_kept] = self.block[self.block_used:self.block_used + nb_kept]
+            self.block_used += nb_kept
+            filled += nb_kept
+        return quaternions
+
+    def drawing_state(self):
+        """
+        Returns the state from which creating_quaternions_array() goes on
+        drawing the same quaternions, that can be saved as json.
+        """
+        if self.block_state is None:
+            return {"rng_state": self.rng.bit_generator.state, "block_used": 0}
+        return {"rng_state": self.block_state, "block_used": self.block_used}
+
+    def restoring_drawing(self, state):
+        """
+        Sets the state of the generator and of the block returned by drawing_state().
+        """
+        self.rng.bit_generator.state = state["rng_state"]
+        self.block, self.block_used, self.block_state = np.empty((0, 4)), 0, None
+        if state["block_used"]:
+            self.drawing_block()
+            self.block_used = state["block_used"]
+
+    def create_space_array(self, chunk_size=100000):
+        """
+        Returns an array of shape (n, 4) formed by n different quaternions evenly
+        distributed on a surface of an hypersphere. The quaternions are drawn by
+        chunks and the duplicates are removed by sorting the whole array, keeping
+        the order of the draws: the space holds the first n different
+        quaternions drawn, so that a smaller space of the same seed is the
+        beginning of a bigger one.
+
+        chunk_size: number of quaternions drawn at once
+        """
+        space = np.empty((0, 4))
+        while len(space) < self.nb_quaternions:
+            missing = self.nb_quaternions - len(space)
+            chunks = [self.creating_quaternions_array(min(chunk_size, missing - start))
+                      for start in range(0, missing, chunk_size)]
+            space = np.concatenate([space] + chunks)
+            # np.unique sorts the rows, we keep the first draw of every quaternion
+            _, first = np.unique(space, axis=0, return_index=True)
+            space = space[np.sort(first)]
+        return space
+
+    def create_space_distribution_batch(self, chunk_size=100000):
+        """
+        Returns a list of quaternions of the same kind as the one of
+        create_space_distribution() (np.quaternion, with the components in the
+        same order), drawn by the batched sampler create_space_array() from the
+        seeded generator of the space.
+
+        chunk_size: number of quaternions drawn at once
+        """
+        return list(quaternion.as_quat_array(self.create_space_array(chunk_size)))
+
+    def create_space_super_fibonacci(self):
+        """
+        Returns an array of shape (n, 4) of quaternions spread evenly on the
+        hypersphere by the super-Fibonacci spiral of Alexa (2022), without any
+        random draw nor rejection.
+        """
+        # phi and psi are the two irrational numbers of the spiral
+        phi, psi = np.sqrt(2), 1.533751168755204288118041
+        s = np.arange(self.nb_quaternions) + 0.5
+        r, big_r = np.sqrt(s / self.nb_quaternions), np.sqrt(1 - s / self.nb_quaternions)
+        alpha, beta = 2 * np.pi * s / phi, 2 * np.pi * s / psi
+        return np.stack([r * np.sin(alpha), r * np.cos(alpha),
+                         big_r * np.sin(beta), big_r * np.cos(beta)], axis=1)
+
+    def radical_inverse(self, indexes, base):
+        """
+        Returns the radical inverse in the given base of every integer of indexes,
+        that is the Halton sequence of this base.
+        """
+        indexes = np.array(indexes)
+        inverse = np.zeros(len(indexes))
+        factor = 1 / base
+        while indexes.any():
+            inverse += factor * (indexes % base)
+            indexes //= base
+            factor /= base
+        return inverse
+
+    def create_space_halton(self, start=0):
+        """
+        Returns an array of shape (n, 4) of quaternions obtained by mapping the
+        Halton sequence of bases 2, 3 and 5 on the hypersphere with the uniform
+        mapping of Shoemake (1992). The first points of a bigger space are the
+        points of a smaller one.
+
+        start: rank of the first point of the sequence
+        """
+        indexes = np.arange(start, start + self.nb_quaternions) + 1
+        u1, u2, u3 = (self.radical_inverse(indexes, base) for base in (2, 3, 5))
+        return np.stack([np.sqrt(1 - u1) * np.sin(2 * np.pi * u2),
+                         np.sqrt(1 - u1) * np.cos(2 * np.pi * u2),
+                         np.sqrt(u1) * np.sin(2 * np.pi * u3),
+                         np.sqrt(u1) * np.cos(2 * np.pi * u3)], axis=1)
+
+    def create_space(self, generator="random"):
+        """
+        Returns an array of shape (n, 4) of quaternions created by the given
+        generator: "random" (create_space_array), "super_fibonacci" or "halton".
+        """
+        generators = {"random": self.create_space_array,
+                      "super_fibonacci": self.create_space_super_fibonacci,
+                      "halton": self.create_space_halton}
+        return generators[generator]()
+
+    def rotation_angles(self, points, space_array, index=None, exclude=None):
+        """
+        Returns, for every point, the smallest angle of the rotation between this
+        point and a quaternion of the space (q and -q being the same rotation),
+        the nearest quaternion being found by a QuaternionIndex so that the
+        points are never compared with the whole space.
+
+        points: array of shape (m, 4)
+        space_array: array of shape (n, 4)
+        index: QuaternionIndex built on space_array, built here if None
+        exclude: array of m indexes of quaternions of the space not compared
+        with the points (the point itself)
+        """
+        if index is None:
+            index = QuaternionIndex(space_array)
+        _, distances = index.nearest(points, exclude)
+        # the angle of the rotation between two unitary quaternions at a
+        # distance d is 4 arcsin(d / 2), more accurate than arccos near 0
+        return 4 * np.arcsin(np.minimum(distances / 2, 1))
+
+    def dispersion(self, space, probes=10000):
+        """
+        Returns the dispersion of the rotations of the space, in radians: the
+        minimal angle between two quaternions of the space, and an estimation of
+        the covering radius, which is the greatest angle between a rotation and
+        the nearest one in the space, measured on probes rotations drawn randomly.
+
+        space: space of quaternions
+        probes: number of rotations drawn to estimate the covering radius, or
+        array of these rotations
+        """
+        space_array = self.space_as_array(space)
+        index = QuaternionIndex(space_array)
+        # a quaternion is not compared with itself
+        min_angle = self.rotation_angles(space_array, space_array, index,
+                                         exclude=np.arange(len(space_array))).min()
+        if np.isscalar(probes):
+            probes = Space(probes, 0, self.rng).create_space_array()
+        covering_radius = self.rotation_angles(probes, space_array, index).max()
+        return {"min_angle": min_angle, "covering_radius": covering_radius}
+
+    def finding_resolution(self, target, generator="super_fibonacci", probes=10000):
+        """
+        Returns the smallest number of quaternions of a space created by the
+        generator whose covering radius is lower than target (in radians). The
+        covering radius is estimated with the same probes for every size.
+
+        target: angular resolution wanted, in radians
+        generator: name of the generator given to create_space()
+        probes: number of rotations drawn to estimate the covering radius
+        """
+        probes = Space(probes, 0, self.rng).create_space_array()
+
+        def covering_radius(size):
+            space_array = Space(size, 0, self.rng).create_space(generator)
+            return self.rotation_angles(probes, space_array).max()
+
+        # the number of quaternions is doubled until the target is reached,
+        # then searched by bisection
+        low, high = 1, 2
+        while covering_radius(high) > target:
+            low, high = high, high * 2
+        while high - low > 1:
+            middle = (low + high) // 2
+            if covering_radius(middle) > target:
+                low = middle
+            else:
+                high = middle
+        return high
+
     def calcul_quaternion_transformation(self, q1, q2):
         """
         Returns the quaternion equivalent to the transformation 
@@ -74,8 +308,7 @@ class Space():
         q1: quaternion at the beginning 
         q2: quaternion at the end
         """
-        transformation = q1.inverse() * q2
-        return transformation
+        return quaternion.as_quat_array(relative_transform(self.components(q1), self.components(q2)))
 
     def find_next_quaternion(self, q_now, espace, transf_prec, first):
         """
@@ -86,84 +319,392 @@ class Space():
         with the previous position.
         For this project, we decided to chose a random quaternion between the one 
         which minimizes the distance and self.neighbour. 
+        The space is scored by find_next_quaternion_array().
 
         q_now : the quaternion we are now
         space: space of quaternions evenly distributed in hypersphere
         transf_prec : the transformation applied to the previous quaternion to arrive
         at the actual quaternion q_now
+        first : if False, q_now is in the space and can not be chosen
         """
-        # In order to chose the best next quaternion, we must create an ordered dictionary
-        # (meaning an indexed dictionary)
-        distances = collections.OrderedDict()
-        space = copy.copy(espace)
+        space_array = self.space_as_array(espace)
+        exclude = None
         if(first == False):
-            space.remove(q_now)
-        for i, _ in enumerate(space):
-            # qt1 is the quaternion which multiplied by rd_q1 gives space_array[i]
-            qt1 = self.calcul_quaternion_transformation(q_now, space[i])
-            # we compute the distance between the transformation applied before
-            # and qt1 that we want to be minimal
-            first_term = (transf_prec - qt1).absolute()
-            # we compute the distance between the quaternion with null angle and qt1
-            # that we want to be minimal 
-            second_term = (self.q0 - qt1).absolute()
-            # the final distance is the sum between the previous distances
-            distance = first_term + second_term
-            # we append the distance in the dictionnary associated to the quaternion
-            distances[distance] = space[i]
-        # we need to sort the distances, beginning by the lowest
-        sorted_distance =  collections.OrderedDict(sorted(distances.items(), key=lambda t: t[0]))
-        q2 = list(sorted_distance.items())
-        #We get a random index between zero and self.neighbour to get out best_q2
+            found = np.flatnonzero((space_array == self.components(q_now)).all(axis=1))
+            if not len(found):
+                raise ValueError("q_now is not in the space")
+            exclude = found[0]
+        _, best_q2, transformation = self.find_next_quaternion_array(
+            q_now, space_array, transf_prec, exclude)
+        return best_q2, transformation
+
+    def space_as_array(self, space):
+        """
+        Returns the space as a contiguous array of shape (n, 4), whether it is
+        given as a list of quaternions or already as an array.
+
+        space: space of quaternions evenly distributed in hypersphere
+        """
+        space = np.asarray(space)
+        if space.dtype == np.quaternion:
+            return quaternion.as_float_array(space)
+        return np.ascontiguousarray(space, dtype=float)
+
+    def components(self, q):
+        """
+        Returns the components (w,x,y,z) of a quaternion, or of a list of
+        quaternions, as an array of floats of shape (4,) or (n, 4).
+
+        q: np.quaternion, list of np.quaternion or array of components
+        """
+        return self.space_as_array(q)
+
+    def scoring_quaternions(self, q_now, space_array, transf_prec):
+        """
+        Returns, for every quaternion of the array, the distance minimized in
+        find_next_quaternion(), computed in a single vectorized pass. As q_now is
+        unitary, |transf_prec - q_now^-1 * q| + |q0 - q_now^-1 * q| is equal to
+        |q_now * transf_prec - q| + |q_now - q|, so the quaternions of the space
+        are not multiplied.
+
+        q_now : the quaternion we are now
+        space_array: array of shape (n, 4) of the quaternions to score
+        transf_prec : the transformation applied to the previous quaternion to arrive
+        at the actual quaternion q_now
+        """
+        q_now, transf_prec = self.components(q_now), self.components(transf_prec)
+        return (norm_distance(space_array, multiply(q_now, transf_prec))
+                + norm_distance(space_array, q_now))
+
+    def choosing_neighbour(self, candidates, distances):
+        """
+        Returns one of the candidates, chosen randomly between the one which
+        minimizes the distance and self.neighbour, as in find_next_quaternion().
+
+        candidates: indexes of the self.neighbour best quaternions
+        distances: distances associated to the candidates
+        """
+        # equal distances are ordered by index, so that none is lost
+        candidates = candidates[np.lexsort((candidates, distances))]
         if self.neighbour != 0:
-            rd_index = np.random.randint(0,self.neighbour)
-        else : 
+            rd_index = self.rng.integers(0, self.neighbour)
+        else :
             rd_index = self.neighbour
-        best_q2 = q2[rd_index][1]
-        # transformation is the quaternion which multiplied by rd_q1 gives best_q2
-        transformation = self.calcul_quaternion_transformation(q_now, best_q2)
-        return best_q2, transformation
+        return candidates[min(rd_index, len(candidates) - 1)]
 
-    def plot_hypersphere(self, space, colorsMap='jet'):
+    def choosing_next(self, q_now, space_array, transf_prec, exclude=None, index=None):
+        """
+        Same as find_next_quaternion_array(), with the quaternions given and
+        returned as arrays of 4 components.
+        """
+        instrument = self.instrument
+        if instrument is not None:
+            tic = time.perf_counter()
+        nb_candidates = min(max(self.neighbour, 1), len(space_array) - (exclude is not None))
+        if index is not None:
+            candidates, distances = index.query(self, q_now, transf_prec, nb_candidates, exclude)
+        else:
+            distances = self.scoring_quaternions(q_now, space_array, transf_prec)
+            if exclude is not None:
+                distances[exclude] = np.inf
+            candidates = np.argpartition(distances, nb_candidates - 1)[:nb_candidates]
+            distances = distances[candidates]
+        chosen = self.choosing_neighbour(candidates, distances)
+        best_q2 = np.array(space_array[chosen])
+        transformation = relative_transform(q_now, best_q2)
+        if instrument is not None:
+            instrument.adding_time("walk.choosing_next", time.perf_counter() - tic)
+            # candidates are distinct, so the score of the chosen one is found once
+            instrument.observing("walk.step_score", distances[candidates == chosen][0])
+            # angle of the rotation of the transformation, as geodesic_angle()
+            # from q0, computed on its w component alone
+            instrument.observing("walk.step_angle", 2 * math.acos(min(abs(transformation[0]), 1.)))
+        return chosen, best_q2, transformation
+
+    def find_next_quaternion_array(self, q_now, space_array, transf_prec, exclude=None,
+                                   index=None):
+        """
+        Same as find_next_quaternion() on an array of shape (n, 4): every quaternion
+        is scored at once and only the self.neighbour best ones are selected with
+        argpartition, without copying nor sorting the space. Returns the index
+        of the best next position, the position and the transformation associated.
+
+        q_now : the quaternion we are now
+        space_array: array of shape (n, 4) of quaternions evenly distributed in hypersphere
+        transf_prec : the transformation applied to the previous quaternion to arrive
+        at the actual quaternion q_now
+        exclude : index of q_now in space_array, that can not be chosen
+        index : QuaternionIndex built on space_array, used to score only the
+        quaternions near the best positions instead of the whole space
+        """
+        chosen, best_q2, transformation = self.choosing_next(
+            self.components(q_now), space_array, self.components(transf_prec), exclude, index)
+        return (chosen, quaternion.as_quat_array(best_q2),
+                quaternion.as_quat_array(transformation))
+
+    def plot_hypersphere(self, space, colorsMap='jet', filepath='quaternions_distribution.png',
+                         mode='auto', max_points=2000, bins=64, return_buffer=False):
         """
         Plots a sphere in a 3D space, and all the axis of rotation for every
-        quaternion created in the space.
+        quaternion created in the space. The figure is drawn off-screen with the
+        Agg backend, saved in filepath and returned, or returned as an RGBA array
+        if return_buffer is True.
 
         space: space of quaternions evenly distributed in hypersphere
+        colorsMap: name of the colormap of the values w
+        filepath: path of the image saved, None to save nothing
+        mode: "arrows" draws one arrow per quaternion, "points" draws the points
+        (x,y,z) of at most max_points quaternions drawn randomly, "density" draws
+        the 2D histograms of the projections of the points (x,y,z) on the planes
+        of the axes, and "auto" draws arrows for small spaces and points otherwise
+        max_points: greatest number of arrows or points drawn
+        bins: number of bins of the histograms on every axis
+        return_buffer: if True, returns the RGBA array of the image instead of the figure
         """
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib import colors
+        # Axes3D registers the 3d projection in the older versions of matplotlib
+        from mpl_toolkits.mplot3d import Axes3D
+        import matplotlib.cm as cmx
         #We need to get every component of the quaternions separately
-        X, Y, Z ,W = np.array([]),np.array([]),np.array([]),np.array([])
-
-        for i, space in enumerate(space):
-            X = np.append(X, space.x)
-            Y = np.append(Y, space.y)
-            Z = np.append(Z, space.z)
-            W = np.append(W, space.w)
-        # parameters of the colormap
-        cm = plt.get_cmap(colorsMap)
-        cNorm = colors.Normalize(vmin=min(W), vmax=max(W))
-        scalarMap = cmx.ScalarMappable(norm=cNorm, cmap=cm)
-        # parameters of the figure
-        fig = plt.figure()
-        ax = Axes3D(fig)
-        # plot of the hypersphere
-        u = np.linspace( 0, 2 * np.pi, 50 )
-        v = np.linspace( 0, np.pi, 25 )
-        x = 1 * np.outer( np.cos( u ), np.sin( v ) )
-        y = 1 * np.outer( np.sin( u ), np.sin( v ) )
-        z = 1 * np.outer( np.ones( np.size( u ) ), np.cos( v ) )
-        ax.plot_wireframe( x, y, z, color='g', alpha=.3 ) 
-        # plot of the components (x,y,z) of everyquaternion as a vector
-        # with a color associated to the value w.
-        ax.quiver(0, 0, 0, X, Y, Z, color=scalarMap.to_rgba(W))
-        scalarMap.set_array(W)
-        fig.colorbar(scalarMap,label='Value of rotation')
-        plt.axis('off')
-        plt.title('Quaternions distribution in hypersphere')  
-        plt.show()
-        plt.savefig('quaternions_distribution.png')
-
-    def explore_space(self, space):
+        W, X, Y, Z = self.space_as_array(space).T
+        if mode == 'auto':
+            mode = 'arrows' if len(W) <= max_points else 'points'
+        if mode != 'density' and len(W) > max_points:
+            # a generator of its own, so that a plot does not change the walks
+            kept = np.random.default_rng(0).choice(len(W), max_points, replace=False)
+            W, X, Y, Z = W[kept], X[kept], Y[kept], Z[kept]
+        # the figure is not attached to pyplot, so nothing is shown on a screen
+        fig = Figure(figsize=(13, 5) if mode == 'density' else None)
+        FigureCanvasAgg(fig)
+        if mode == 'density':
+            # histograms of the projections (x,y), (x,z) and (y,z) of the points
+            axes = fig.subplots(1, 3)
+            for ax, (first, second), names in zip(axes, [(X, Y), (X, Z), (Y, Z)],
+                                                  ['xy', 'xz', 'yz']):
+                counts, _, _ = np.histogram2d(first, second, bins=bins, range=[[-1, 1], [-1, 1]])
+                image = ax.imshow(counts.T, origin='lower', extent=(-1, 1, -1, 1), cmap=colorsMap)
+                ax.set_xlabel(names[0])
+                ax.set_ylabel(names[1])
+            fig.colorbar(image, ax=list(axes), label='Number of quaternions',
+                         orientation='horizontal')
+        else:
+            # parameters of the colormap
+            cNorm = colors.Normalize(vmin=W.min(), vmax=W.max())
+            scalarMap = cmx.ScalarMappable(norm=cNorm, cmap=colorsMap)
+            ax = fig.add_subplot(projection='3d')
+            # plot of the hypersphere
+            u = np.linspace( 0, 2 * np.pi, 50 )
+            v = np.linspace( 0, np.pi, 25 )
+            x = 1 * np.outer( np.cos( u ), np.sin( v ) )
+            y = 1 * np.outer( np.sin( u ), np.sin( v ) )
+            z = 1 * np.outer( np.ones( np.size( u ) ), np.cos( v ) )
+            ax.plot_wireframe( x, y, z, color='g', alpha=.3 ) 
+            if mode == 'arrows':
+                # plot of the components (x,y,z) of everyquaternion as a vector
+                # with a color associated to the value w.
+                ax.quiver(0, 0, 0, X, Y, Z, color=scalarMap.to_rgba(W))
+            else:
+                ax.scatter(X, Y, Z, c=scalarMap.to_rgba(W), s=2)
+            scalarMap.set_array(W)
+            fig.colorbar(scalarMap, ax=ax, label='Value of rotation')
+            ax.axis('off')
+        fig.suptitle('Quaternions distribution in hypersphere')
+        fig.canvas.draw()
+        if filepath is not None:
+            fig.savefig(filepath)
+        if return_buffer:
+            return np.asarray(fig.canvas.buffer_rgba()).copy()
+        return fig
+
+    def walking(self, space, steps=None, index=None, start=None):
+        """
+        Same as iter_walk(), yielding the index in the space of every position
+        with the position and the transformation as arrays of 4 components.
+        """
+        # the space is scored as an array, the quaternion we are now being
+        # excluded by its index
+        space_array = self.space_as_array(space)
+        if start is None:
+            current, q, transf = None, self.components(self.q0), self.components(self.q0)
+        else:
+            current, q, transf = start
+            q, transf = self.components(q), self.components(transf)
+        instrument = self.instrument
+        if instrument is not None:
+            # number of visits of every quaternion of the space during this walk
+            visits = np.zeros(len(space_array), dtype=np.int64)
+            nb_visited = 0
+        step = 0
+        while steps is None or step < steps:
+            current, q, transf = self.choosing_next(q, space_array, transf,
+                                                    exclude=current, index=index)
+            if instrument is not None:
+                instrument.counting("walk.steps")
+                if visits[current]:
+                    instrument.counting("walk.revisits")
+                else:
+                    nb_visited += 1
+                visits[current] += 1
+                instrument.setting("walk.revisit_rate", 1 - nb_visited / (step + 1))
+                # part of the space visited, as the walk goes on
+                instrument.setting("walk.coverage", nb_visited / len(space_array))
+                instrument.ticking()
+            yield current, q, transf
+            step += 1
+
+    def iter_walk(self, space, steps=None, index=None, start=None):
+        """
+        Yields, one step at a time, every best new position and the transformation
+        associated, from the quaternion associated with the null angle. Only the
+        last position is kept in memory, so the walk can be as long as needed.
+
+        space: space of quaternions evenly distributed in hypersphere
+        steps: number of positions yielded, None to walk without end
+        index: QuaternionIndex built on the space
+        start: (index in the space, position, transformation) of the last step
+        of a previous walk to continue
+        """
+        for _, q, transf in self.walking(space, steps, index, start):
+            yield quaternion.as_quat_array(q), quaternion.as_quat_array(transf)
+
+    def resuming_walk(self, space_array, last_rows):
+        """
+        Returns the start of iter_walk() continuing a walk from the last rows
+        written by a RotationsWriter, the position and the transformation being
+        arrays of 4 components.
+
+        space_array: array of shape (n, 4) of the space walked
+        last_rows: array of the last (at most two) rows written
+        """
+        q = np.array(last_rows[-1, :4], dtype=float)
+        if last_rows.shape[1] == 8:
+            transf = np.array(last_rows[-1, 4:], dtype=float)
+        elif len(last_rows) > 1:
+            transf = relative_transform(last_rows[-2, :4], q)
+        else:
+            transf = relative_transform(self.components(self.q0), q)
+        found = np.flatnonzero((space_array == last_rows[-1, :4]).all(axis=1))
+        if not len(found):
+            raise ValueError("the last position written {} is not in the space walked".format(
+                last_rows[-1, :4].tolist()))
+        return found[0], q, transf
+
+    def writing_walk(self, space, filepath, steps=None, index=None, buffer_size=10000,
+                     with_transformations=False):
+        """
+        Writes the positions of iter_walk() in a csv file by chunks of buffer_size
+        rows, with the state of the random generator. If the file was partially
+        written by a previous call, the walk resumes from its last chunk written.
+        The state file is removed once a walk of a fixed number of steps is
+        complete. Returns the number of positions in the file.
+
+        space: space of quaternions evenly distributed in hypersphere
+        filepath: path of the csv file
+        steps: number of positions of the whole walk, None to walk without end
+        index: QuaternionIndex built on the space
+        buffer_size: number of positions kept in memory before being written
+        with_transformations: if True, the transformation is written after the
+        position on every row
+        """
+        space_array = self.space_as_array(space)
+        writer = RotationsWriter(filepath, buffer_size, with_transformations,
+                                 state=lambda: self.rng.bit_generator.state)
+        start = None
+        if writer.rows:
+            self.rng.bit_generator.state = writer.state
+            start = self.resuming_walk(space_array, writer.last_rows())
+        remaining = None if steps is None else max(steps - writer.rows, 0)
+        with writer:
+            for _, q, transf in self.walking(space_array, remaining, index, start):
+                writer.write(q, transf)
+        if steps is not None and writer.rows >= steps:
+            # the walk is complete, so there is nothing left to resume
+            writer.removing_state()
+        return writer.rows
+
+    def touring(self, space, index=None):
+        """
+        Same as iter_tour(), yielding the index in the space of every position
+        with the position and the transformation as arrays of 4 components.
+        """
+        space_array = self.space_as_array(space)
+        remaining = np.arange(len(space_array))
+        position_of = np.arange(len(space_array))
+        nb_remaining = len(space_array)
+        # quaternions not visited, in the order of remaining, so that they are
+        # scored without being gathered at every step
+        not_visited = np.array(space_array) if index is None else None
+        q, transf = self.components(self.q0), self.components(self.q0)
+        instrument = self.instrument
+        while nb_remaining:
+            if index is not None:
+                current, q, transf = self.choosing_next(q, space_array, transf, index=index)
+                index.remove(current)
+            else:
+                chosen, q, transf = self.choosing_next(q, not_visited[:nb_remaining], transf)
+                current = remaining[chosen]
+            # swap-remove of the quaternion visited
+            position, last = position_of[current], remaining[nb_remaining - 1]
+            remaining[position] = last
+            position_of[last] = position
+            if not_visited is not None:
+                not_visited[position] = not_visited[nb_remaining - 1]
+            nb_remaining -= 1
+            if instrument is not None:
+                instrument.counting("tour.steps")
+                instrument.setting("tour.coverage", 1 - nb_remaining / len(space_array))
+                instrument.ticking()
+            yield current, q, transf
+
+    def iter_tour(self, space, index=None):
+        """
+        Yields every best new position and the transformation associated, from the
+        quaternion associated with the null angle, such as every quaternion of the
+        space is visited exactly once. The quaternions not visited yet are kept
+        at the beginning of an array of indexes, a visited quaternion being
+        swapped with the last one not visited.
+
+        space: space of quaternions evenly distributed in hypersphere
+        index: QuaternionIndex built on the space, from which the visited
+        quaternions are removed
+        """
+        for _, q, transf in self.touring(space, index):
+            yield quaternion.as_quat_array(q), quaternion.as_quat_array(transf)
+
+    def explore_tour(self, space, index=None, filepath=None, buffer_size=10000):
+        """
+        Walks through every quaternion of the space exactly once with iter_tour().
+        Returns a TourReport with the part of the space visited, the total angle
+        of the transformations (the length of the path, in radians) and the
+        greatest of them with its step.
+
+        space: space of quaternions evenly distributed in hypersphere
+        index: QuaternionIndex built on the space
+        filepath: path of the csv file where the positions are written, if any
+        buffer_size: number of positions kept in memory before being written
+        """
+        space_array = self.space_as_array(space)
+        identity = self.components(self.q0)
+        writer = None
+        if filepath is not None:
+            writer = RotationsWriter(filepath, buffer_size, resume=False)
+        nb_steps, path_length, worst_step, worst_angle = 0, 0., None, 0.
+        for step, (_, q, transf) in enumerate(self.touring(space_array, index)):
+            # angle of the rotation associated to the transformation
+            angle = float(geodesic_angle(identity, transf))
+            path_length += angle
+            if angle > worst_angle:
+                worst_step, worst_angle = step, angle
+            nb_steps += 1
+            if writer is not None:
+                writer.write(q)
+        if writer is not None:
+            writer.close()
+        return TourReport(nb_steps / len(space_array), path_length, worst_step, worst_angle)
+
+    def explore_space(self, space, index=None, filepath="rotations_csv.csv"):
         """
         From the quaternion associated with the null angle, creates the sequence of
         every best new position and transformation associated. Returns an array with every 
@@ -171,56 +712,216 @@ class Space():
         to make the rotations.
 
         space: space of quaternions evenly distributed in hypersphere
+        index: QuaternionIndex built on the space, to find the next positions
+        without scanning the whole space
+        filepath: path of the rotations file, saved as binary (with the
+        transformations) if it ends with .npy
         """
         # we create three numpy arrays to get the positions and the transformations
         # "position_list_quat" and "position_list" are the same arrays, with the 
         # difference that one contains the quaternions as quaternions Object and the 
         # other as numpy arrays.
         position_list_quat = []
-        position_list = []
-        transf_list = []
-        # first, we find the best quaternion and the transformation associated 
-        # beginning by q0, with a transformation of q0. 
-        q, transf = self.find_next_quaternion(self.q0, space, self.q0, first=True)
-        # We get the vector part (x,y,z) from q0 as a numpy array and
-        # appends it to the position array
-        position_list_quat.append(quaternion.as_float_array(q))
-        position_list.append(q)
-        # we append the transformation in the transf_list as a numpy array
-        # [w,x,y,z]
-        transf_list.append(transf)
-        # for every quaternion in space :
-        for i in range(10000):
-            # we find the best next quaternion and transformation associated,
-            # beginning with what we found for q0
-            q, transf = self.find_next_quaternion(q, space, transf, first=False)
+        transf_array = []
+        # the walk begins by q0, with a transformation of q0, and goes on for
+        # 10000 steps after the first position
+        for _, q, transf in self.walking(space, 10001, index):
             # we append the position and the transformation respectively in 
-            # the two numpy arrays.
-            position_list_quat.append(quaternion.as_float_array(q))
-            position_list.append(q)
-            transf_list.append(transf)
+            # the arrays.
+            position_list_quat.append(q)
+            transf_array.append(transf)
+        # the quaternions objects are created once the walk is over
+        position_list = list(quaternion.as_quat_array(np.array(position_list_quat)))
+        transf_list = list(quaternion.as_quat_array(np.array(transf_array)))
         # Finally, we create a csv file containing every position
         # that can be used in Blender to create the rotations of our stl files. 
-        np.savetxt("rotations_csv.csv", position_list_quat, delimiter=",")
+        if filepath.endswith(".npy"):
+            save_rotations(filepath, position_list_quat, transf_array)
+        else:
+            np.savetxt(filepath, position_list_quat, delimiter=",")
         return position_list, transf_list, position_list_quat
 
-    def create_gif(self, filepath, filename):
+    def listing_frames(self, filepath, stride=1):
+        """
+        Returns the names of the png frames of a folder (searched recursively) or
+        of a zip archive created by turning_object, sorted by the number of the
+        frame, keeping one frame every stride frames.
+
+        filepath: path to the folder or to the zip archive
+        stride: step between two frames kept
+        """
+        if filepath.endswith(".zip"):
+            with zipfile.ZipFile(filepath) as archive:
+                names = [name for name in archive.namelist() if name.endswith(".png")]
+        else:
+            names = glob.glob(filepath + "**/*.png", recursive = True)
+        # frame_10 must come after frame_2, so the frames are sorted by their number
+        def number(name):
+            digits = re.findall(r"\d+", os.path.basename(name))
+            return (int(digits[-1]) if digits else -1, name)
+        return sorted(names, key=number)[::stride]
+
+    def reading_frames(self, filepath, names, workers=4, lookahead=16):
+        """
+        Yields the frames in the order of names, decoded and quantized to a
+        palette of 256 colors by a pool of threads which works at most lookahead
+        frames ahead, so that only these frames are kept in memory.
+
+        filepath: path to the folder or to the zip archive of the frames
+        names: names of the frames returned by listing_frames()
+        workers: number of threads decoding the frames
+        lookahead: number of frames decoded in advance
+        """
+        from PIL import Image
+        archive = zipfile.ZipFile(filepath) if filepath.endswith(".zip") else None
+
+        def decoding(name):
+            if archive is not None:
+                image = Image.open(io.BytesIO(archive.read(name)))
+            else:
+                image = Image.open(name)
+            return image.convert("RGB").quantize(colors=256)
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = collections.deque()
+                for name in names:
+                    pending.append(executor.submit(decoding, name))
+                    if len(pending) >= lookahead:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+        finally:
+            if archive is not None:
+                archive.close()
+
+    def create_gif(self, filepath, filename, stride=1, duration=200, workers=4, lookahead=16):
         """
         Saves a GIF image for every STL rotated with blender, using the transformation
-        csv file.
+        csv file. The frames are written in the GIF one after the other as soon
+        as they are decoded, so the memory used does not depend on their number.
 
-        filepath: path to the folder containing images for the gif
+        filepath: path to the folder containing images for the gif, or to the zip
+        archive created by turning_object
+        filename: path of the gif, without its extension
+        stride: step between two frames kept in the gif
+        duration: duration of every frame, in milliseconds
+        workers: number of threads decoding and quantizing the frames
+        lookahead: number of frames decoded in advance
         """
-        frames=[]
-        # for every file in a given path
-        for file in glob.glob(filepath + "**/*.png", recursive = True):
-            # we copy an image and append it in the array
-            keep = copy.deepcopy(Image.open(file))
-            frames.append(keep)
-        # then we create the gif fil.
-        frames[0].save(filename+'.gif', format='GIF', append_images=frames[1:], save_all=True, duration=200, loop=0)
+        from PIL import GifImagePlugin
+        names = self.listing_frames(filepath, stride)
+        with open(filename + '.gif', 'wb') as gif:
+            for i, frame in enumerate(self.reading_frames(filepath, names, workers, lookahead)):
+                if i == 0:
+                    # header of the gif, repeated without end
+                    header, _ = GifImagePlugin.getheader(frame, info={"loop": 0})
+                    gif.write(b"".join(header))
+                # every frame has its own palette
+                for data in GifImagePlugin.getdata(frame, duration=duration,
+                                                   include_color_table=True):
+                    gif.write(data)
+            gif.write(b";")
+
+# duration of the import of this module and of its dependencies
+IMPORT_SECONDS = time.perf_counter() - IMPORT_START
+
+
+# number of quaternions from which a tour is faster with a QuaternionIndex than
+# by scanning the quaternions not visited (about 75 s for both on a random space)
+TOUR_INDEX_SIZE = 100000
+
+
+def main(argv=None):
+    """
+    Creates a space of quaternions and writes the positions of a walk through it,
+    from the command line. The diagnostics (durations of the import, of the
+    creation of the space and of the walk) are printed on the error output.
+
+    argv: arguments of the command line, sys.argv[1:] by default
+    """
+    parser = argparse.ArgumentParser(description="Creates the rotations used by Blender")
+    parser.add_argument("--size", type=int, default=1000, help="number of quaternions of the space")
+    parser.add_argument("--neighbour", type=int, default=2,
+                        help="number of best quaternions from which the next one is chosen")
+    parser.add_argument("--steps", type=int, default=10001, help="number of positions of the walk")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the random generator")
+    parser.add_argument("--output", default="rotations_csv.csv",
+                        help="rotations file, csv or .npy (binary, with the transformations)")
+    parser.add_argument("--generator", default="random",
+                        choices=["random", "super_fibonacci", "halton"])
+    parser.add_argument("--mode", default="walk", choices=["walk", "tour"],
+                        help="tour visits every quaternion of the space once")
+    parser.add_argument("--index", nargs="?", const="always", default="auto",
+                        choices=["auto", "always", "never"],
+                        help="finds the next positions with a QuaternionIndex: always, never, "
+                        "or (auto) for the tours of at least {} quaternions".format(TOUR_INDEX_SIZE))
+    parser.add_argument("--resume", action="store_true",
+                        help="continues the walk of a csv file written before")
+    parser.add_argument("--cache", default=None,
+                        help="folder where the spaces are saved and loaded (or grown) from")
+    parser.add_argument("--metrics", default=None,
+                        help="json lines file where the measures of the walk are appended")
+    parser.add_argument("--metrics-interval", type=float, default=10.,
+                        help="number of seconds between two snapshots of the measures")
+    args = parser.parse_args(argv)
+    if args.cache is not None and args.generator == "random" and args.seed is None:
+        parser.error("--cache needs a --seed for a random space")
+
+    instrument = None
+    if args.metrics is not None:
+        instrument = Instrumentation(args.metrics, args.metrics_interval,
+                                     {"size": args.size, "neighbour": args.neighbour,
+                                      "generator": args.generator, "mode": args.mode,
+                                      "seed": args.seed, "index": args.index})
+    tic = time.perf_counter()
+    space = Space(args.size, args.neighbour, seed=args.seed, instrument=instrument)
+    if args.cache is not None:
+        # space_cache imports this module, so it is only imported when used
+        from space_cache import SpaceCache
+        space_array = SpaceCache(args.cache).load(args.generator, args.seed, args.size)
+    else:
+        space_array = space.create_space(args.generator)
+    # the index only pays for its traversal once scanning the whole space at
+    # every step of the tour is longer
+    use_index = args.index == "always" or (
+        args.index == "auto" and args.mode == "tour" and len(space_array) >= TOUR_INDEX_SIZE)
+    index = QuaternionIndex(space_array) if use_index else None
+    space_seconds = time.perf_counter() - tic
+
+    tic = time.perf_counter()
+    if args.mode == "walk" and not args.output.endswith(".npy"):
+        # the walk is written by chunks, and can be resumed if it is interrupted
+        if not args.resume and os.path.exists(args.output + ".state"):
+            os.remove(args.output + ".state")
+        nb_positions = space.writing_walk(space_array, args.output, args.steps, index)
+    else:
+        if args.mode == "walk":
+            steps = space.walking(space_array, args.steps, index)
+        else:
+            steps = space.touring(space_array, index)
+        positions, transformations = [], []
+        for _, q, transf in steps:
+            positions.append(q)
+            transformations.append(transf)
+        if args.output.endswith(".npy"):
+            save_rotations(args.output, positions, transformations)
+        else:
+            save_rotations(args.output, positions)
+        nb_positions = len(positions)
+    walk_seconds = time.perf_counter() - tic
+    if instrument is not None:
+        instrument.adding_time("space", space_seconds)
+        instrument.adding_time(args.mode, walk_seconds)
+        instrument.writing()
+
+    print("import: {:.3f} s (matplotlib loaded: {})".format(
+        IMPORT_SECONDS, "matplotlib" in sys.modules), file=sys.stderr)
+    print("space: {} quaternions ({}) in {:.3f} s".format(
+        len(space_array), args.generator, space_seconds), file=sys.stderr)
+    print("{}: {} positions in {:.3f} s, written in {}".format(
+        args.mode, nb_positions, walk_seconds, args.output), file=sys.stderr)
+
 
 if __name__ == '__main__':
-    space = Space(1000, 2)
-    space_dist = space.create_space_distribution()
-    space.explore_space(space_dist)
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+## This module reads the database generated by generate_database.py without
+## extracting it. An index of every frame of the zip archives (and of the tar
+## shards of shard_writer.py) gives its position in its archive with its
+## quaternion, stl file, scale and dimensions, so that any batch of frames can
+## be loaded at once as a numpy array.
+
+import ast, concurrent.futures, csv, glob, io, json, os, struct, zipfile, zlib
+import numpy as np
+
+# fields of the index of the frames
+INDEX_DTYPE = np.dtype([("archive", np.int32), ("offset", np.int64), ("size", np.int64),
+                        ("deflated", np.bool_), ("frame", np.int64), ("quaternion", np.float64, 4),
+                        ("stl", np.int32), ("scale", np.float64), ("dimensions", np.float64, 3)])
+
+
+def parsing_rotation(text):
+    """
+    Returns the quaternion written in a labels file, as a list of strings (csv
+    files read as text) or of numbers.
+    """
+    return [float(value) for value in ast.literal_eval(text)]
+
+
+class DatasetReader():
+    """
+    This class indexes every frame of the archives of a folder, and loads batches
+    of frames by their number in the index, decoding them on a pool of threads.
+    The decoded images can be kept in a memory-mapped cache of uint8 arrays, so
+    that the png files are decoded only once.
+    """
+
+    def __init__(self, folder, size=128, mode="L", workers=4, cache=None):
+        """
+        folder: folder of the zip archives and of the tar shards
+        size: width and height of the frames
+        mode: PIL mode of the arrays returned ("L" for gray levels, "RGB")
+        workers: number of threads decoding the frames
+        cache: path of the memory-mapped cache of the decoded frames, if any
+        """
+        self.folder = folder
+        self.size = size
+        self.mode = mode
+        self.workers = workers
+        self.archives, self.stls = [], []
+        rows = []
+        for path in sorted(glob.glob(os.path.join(folder, "**/*.zip"), recursive=True)):
+            rows += self.indexing_zip(path)
+        for path in sorted(glob.glob(os.path.join(folder, "**/*-[0-9]*.json"), recursive=True)):
+            rows += self.indexing_shard(path)
+        self.index = np.array(rows, dtype=INDEX_DTYPE)
+        self.cache, self.cached = None, None
+        if cache is not None:
+            self.opening_cache(cache)
+
+    def __len__(self):
+        return len(self.index)
+
+    def stl_number(self, name):
+        """
+        Returns the number of an stl file in self.stls.
+        """
+        if name not in self.stls:
+            self.stls.append(name)
+        return self.stls.index(name)
+
+    def indexing_zip(self, path):
+        """
+        Returns the rows of the index of the frames of a zip archive created by
+        turning_object, whose labels file holds the dimensions then the rotations.
+        """
+        archive = len(self.archives)
+        self.archives.append(path)
+        stl, scale = os.path.splitext(os.path.basename(path))[0].rsplit("_", 1)
+        stl = self.stl_number(stl)
+        rows = []
+        with zipfile.ZipFile(path) as zipped, open(path, "rb") as raw:
+            labels = [name for name in zipped.namelist() if name.endswith("_directory_labels.csv")]
+            lines = list(csv.reader(io.TextIOWrapper(zipped.open(labels[0]))))
+            dimensions = [float(value) for value in lines[1]]
+            rotations = {int(line[0]): parsing_rotation(line[1]) for line in lines[3:]}
+            for info in zipped.infolist():
+                if not info.filename.endswith(".png"):
+                    continue
+                # the data begins after the local header, whose extra field can
+                # differ from the one of the central directory
+                raw.seek(info.header_offset + 26)
+                name_length, extra_length = struct.unpack("<HH", raw.read(4))
+                offset = info.header_offset + 30 + name_length + extra_length
+                frame = int(os.path.splitext(os.path.basename(info.filename))[0].split("_")[-1])
+                rows.append((archive, offset, info.compress_size,
+                             info.compress_type == zipfile.ZIP_DEFLATED, frame,
+                             rotations[frame], stl, float(scale), dimensions))
+        return sorted(rows, key=lambda row: row[4])
+
+    def indexing_shard(self, path):
+        """
+        Returns the rows of the index of the frames of a tar shard, from its
+        index file written by ShardWriter.
+        """
+        with open(path) as inputfile:
+            shard = json.load(inputfile)
+        archive = len(self.archives)
+        self.archives.append(os.path.join(os.path.dirname(path), shard["shard"]))
+        rows = []
+        for member in shard["members"]:
+            label = member["label"]
+            rows.append((archive, member["png_offset"], member["png_size"], False,
+                         label["number_image"], label["rotation"], self.stl_number(label["stl"]),
+                         float(label["scale"]), label["dimensions"]))
+        return rows
+
+    def reading(self, number):
+        """
+        Returns the bytes of the png file of a frame of the index.
+        """
+        row = self.index[number]
+        with open(self.archives[row["archive"]], "rb") as inputfile:
+            inputfile.seek(row["offset"])
+            data = inputfile.read(row["size"])
+        if row["deflated"]:
+            data = zlib.decompress(data, -15)
+        return data
+
+    def decoding(self, number):
+        """
+        Returns the image of a frame of the index as an array of uint8.
+        """
+        from PIL import Image
+        return np.asarray(Image.open(io.BytesIO(self.reading(number))).convert(self.mode))
+
+    def opening_cache(self, path):
+        """
+        Opens (or creates) the memory-mapped cache of the decoded frames, and the
+        array telling which frames are already in it.
+        """
+        channels = () if self.mode == "L" else (len(self.mode),)
+        shape = (len(self.index), self.size, self.size) + channels
+        if os.path.exists(path) and os.path.exists(path + ".filled.npy"):
+            self.cache = np.load(path, mmap_mode="r+")
+            self.cached = np.load(path + ".filled.npy", mmap_mode="r+")
+            if self.cache.shape != shape:
+                raise ValueError("the cache {} does not match the index".format(path))
+        else:
+            self.cache = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=shape)
+            self.cached = np.lib.format.open_memmap(path + ".filled.npy", mode="w+",
+                                                    dtype=np.bool_, shape=(len(self.index),))
+
+    def load_batch(self, numbers):
+        """
+        Returns the images of the frames of the index as an array of uint8 of
+        shape (len(numbers), size, size) (with the channels at the end for the
+        modes other than "L"), and the rows of the index of these frames.
+
+        numbers: numbers of the frames in the index
+        """
+        numbers = np.asarray(numbers)
+        if self.cache is not None:
+            missing = np.unique(numbers[~self.cached[numbers]])
+        else:
+            missing = np.unique(numbers)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            decoded = dict(zip(missing, executor.map(self.decoding, missing)))
+        if self.cache is not None:
+            for number, image in decoded.items():
+                self.cache[number] = image
+            self.cached[missing] = True
+            self.cache.flush()
+            self.cached.flush()
+            return np.array(self.cache[numbers]), self.index[numbers]
+        return np.stack([decoded[number] for number in numbers]), self.index[numbers]
@@ -15,6 +15,19 @@ from math import radians
 from mathutils import Euler
 from shutil import make_archive
 
+# the modules of this folder are not in the path of Blender
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from rotations_io import load_rotations
+from render_scheduler import stl_scales, unit_labels, unit_parser
+from render_cache import RenderCache
+from shard_writer import ShardWriter
+from instrumentation import Instrumentation
+
+# settings of the camera, the light and the render, which are part of the key
+# of the images in the render cache
+RENDER_SETTINGS = {"resolution": 128, "use_gtao": True, "use_bloom": True,
+                   "ortho_scale": 40, "distance_camera_target": 100, "light_energy": 50000}
+
 
 def reinitialization():
     """
@@ -89,7 +102,7 @@ def addingcamera():
     """
     # --------------- Camera parameters ---------------
     opening_camera = 35
-    distance_camera_target = 100
+    distance_camera_target = RENDER_SETTINGS["distance_camera_target"]
     field_camera = 30
     # --------------- ---------------------------------
     # create new camera
@@ -117,7 +130,7 @@ def addingcamera():
     # change camera object type to orthographic
     bpy.context.object.data.type = 'ORTHO'
     # change orthographic scale
-    bpy.context.object.data.ortho_scale = 40
+    bpy.context.object.data.ortho_scale = RENDER_SETTINGS["ortho_scale"]
     # set camera object to focus mesh object
     bpy.context.object.data.dof.focus_object = bpy.data.objects["Target"]
     
@@ -131,7 +144,7 @@ def addinglight():
     # create new light of type spot
     light_data = bpy.data.lights.new(name="light", type='SPOT')
     # set light energy to 50000W ( mesh objects are huge, needing powerful energy)
-    light_data.energy = 50000
+    light_data.energy = RENDER_SETTINGS["light_energy"]
     # create new light object
     light_obj = bpy.data.objects.new("light", light_data)
     # link light object to scene
@@ -148,10 +161,20 @@ def addinglight():
         bpy.data.objects[light].location = (100,0,0)
         
 
-def turning_object(filepath, scale, csv_rotations):
+def turning_object(filepath, scale, csv_rotations, start=None, stop=None, output=None,
+                   archive=True, cache=None, shard_size=None, instrument=None):
     """
     filepath : path of stl file 
     scale : scale to apply on x axis 
+    csv_rotations : path of the rotations file, csv or .npy (memory-mapped)
+    start, stop : range of the rotations rendered, every rotation by default
+    output : folder of the dataset, the folder "dataset" next to the blend file by default
+    archive : if False, the labels of the range are written in their own file and
+    the folder is not archived, as done by the units of render_scheduler.py
+    cache : RenderCache from which the images already rendered are copied
+    shard_size : if given, every frame is appended with its label to tar shards of
+    shard_size frames as soon as it is rendered, instead of the folder and the zip
+    instrument : Instrumentation receiving the render time and the size of every frame
     Sets path, rotations and render parameters, save to path every rotated images
     and creates csv file with the number of the frame and the value of rotation of each
     axis
@@ -171,7 +194,7 @@ def turning_object(filepath, scale, csv_rotations):
     # create new folder
     png_files = "dataset"
     # get the path where we want to store the png
-    png_path = os.path.join(blend_path,png_files)
+    png_path = output or os.path.join(blend_path,png_files)
     # get the final path
     dirpath = os.path.join(png_path, name_stl)
 
@@ -179,10 +202,10 @@ def turning_object(filepath, scale, csv_rotations):
     target = bpy.data.objects["Target"]
     # get dimensions on x, y and z axis
     dimension_x, dimension_y, dimension_z = target.dimensions
-    # get the quaternion rotations stored in a csv file
-    # and store it in the list "rotations"
-    with open(csv_rotations) as inputfile:
-        rotations = list(csv.reader(inputfile))
+    # get the quaternion rotations stored in a csv or .npy file
+    # and store it in the array "rotations"
+    rotations = load_rotations(csv_rotations, start, stop)
+    first_frame = start or 0
 
     # --------------- Render parameters ---------------
     target.rotation_mode = "QUATERNION"
@@ -192,34 +215,86 @@ def turning_object(filepath, scale, csv_rotations):
     # set camera active for render
     scene.camera = bpy.data.objects["Camera1"]
     # set x and y resolution of rendered image
-    scene.render.resolution_x = 128
-    scene.render.resolution_y = 128
+    scene.render.resolution_x = RENDER_SETTINGS["resolution"]
+    scene.render.resolution_y = RENDER_SETTINGS["resolution"]
     # set quality of rendered image
     scene.render.resolution_percentage = 100
     # set extension of rendered image
     scene.render.image_settings.file_format = "PNG"
     # active ambiant occlusion of Eevee
-    bpy.context.scene.eevee.use_gtao = True
+    bpy.context.scene.eevee.use_gtao = RENDER_SETTINGS["use_gtao"]
     # active bloom of Eevee
-    bpy.context.scene.eevee.use_bloom = True
+    bpy.context.scene.eevee.use_bloom = RENDER_SETTINGS["use_bloom"]
+
+    # --------------- Shards ---------------
+    shards = None
+    if shard_size is not None:
+        os.makedirs(dirpath, exist_ok=True)
+        # every range of frames has its own shards, so that several units can
+        # write in the same folder
+        prefix = name_stl if archive else "{}_{}".format(name_stl, first_frame)
+        shards = ShardWriter(dirpath, prefix, shard_size)
+        # the frames of the shards finished by a previous job are not rendered again
+        written = shards.written_keys()
+        dimensions = [dimension_x, dimension_y, dimension_z]
 
     # --------------- Rotations ---------------
+    # the folder is created before the images are saved or copied from the cache
+    os.makedirs(dirpath, exist_ok=True)
     # for each rotation stored in the list
-    for i, _ in enumerate(rotations): 
+    for i, rotation in enumerate(rotations, first_frame): 
+        if shards is not None and "frame_{:08d}".format(i) in written:
+            continue
         # apply (w,x,y,z) values of the quaternion to rotate
         # the target
-        target.rotation_quaternion[0] = float(rotations[i][0])
-        target.rotation_quaternion[1] = float(rotations[i][1])
-        target.rotation_quaternion[2] = float(rotations[i][2])
-        target.rotation_quaternion[3] = float(rotations[i][3])
+        target.rotation_quaternion = rotation[:4].tolist()
         # create new filepath with the name of the stl, the scale and the number of the frame
-        filepath = os.path.join(dirpath, "frame_{}.png")
-        # render the image
-        bpy.ops.render.render()
-        # save the render as png file
-        bpy.data.images["Render Result"].save_render(filepath.format(i))
+        framepath = os.path.join(dirpath, "frame_{}.png").format(i)
+        # the image is copied from the cache if it was already rendered
+        if cache is not None:
+            key = cache.key(filepath, scale, RENDER_SETTINGS, rotation)
+        if cache is None or not cache.get(key, framepath):
+            if instrument is not None:
+                tic_frame = time.perf_counter()
+            # render the image
+            bpy.ops.render.render()
+            # save the render as png file
+            bpy.data.images["Render Result"].save_render(framepath)
+            if instrument is not None:
+                frame_seconds = time.perf_counter() - tic_frame
+                instrument.adding_time("render.frame", frame_seconds)
+                instrument.observing("render.frame_seconds", frame_seconds)
+            if cache is not None:
+                cache.put(key, framepath)
+        elif instrument is not None:
+            instrument.counting("render.cache_hits")
+        if instrument is not None:
+            frame_bytes = os.path.getsize(framepath)
+            instrument.counting("render.frames")
+            instrument.counting("render.bytes_written", frame_bytes)
+            instrument.observing("render.frame_bytes", frame_bytes)
+            instrument.ticking()
+        if shards is not None:
+            # the frame is moved from its file to the shard with its label
+            with open(framepath, "rb") as inputfile:
+                shards.write("frame_{:08d}".format(i), inputfile.read(),
+                             {"number_image": i, "rotation": rotation[:4].tolist(),
+                              "stl": split_name_file, "scale": float(scale),
+                              "dimensions": dimensions})
+            os.remove(framepath)
     # when all the png are created, create a zip archive of the folder
     print("Images saved in {:.2f} seconds".format(time.time() - tic))
+    if instrument is not None:
+        instrument.adding_time("render.images", time.time() - tic)
+    if cache is not None:
+        print("Render cache: {}".format(cache.stats()))
+    if shards is not None:
+        # the labels are already in the shards
+        shards.close()
+        if instrument is not None:
+            instrument.writing()
+        print("Generation Finished!")
+        return
     
     # --------------- Labels ---------------
     labels = []
@@ -228,10 +303,13 @@ def turning_object(filepath, scale, csv_rotations):
     dimensions = [dimension_x, dimension_y, dimension_z]
     header = ["number_image","transformation applied from precedent image"]
     # create new csv file in the corresponding folder
-    f = open(dirpath +"/"+name_stl+"_directory_labels.csv", "w")
-    for i, _ in enumerate(rotations): 
+    if archive:
+        f = open(dirpath +"/"+name_stl+"_directory_labels.csv", "w")
+    else:
+        f = open(unit_labels(dirpath, name_stl, first_frame, first_frame + len(rotations)), "w")
+    for i, rotation in enumerate(rotations, first_frame): 
         # add each rotation in the list of labels
-        labels.append((i, rotations[i]))
+        labels.append((i, rotation[:4].tolist()))
     
     with f:
         writer = csv.writer(f)
@@ -245,15 +323,25 @@ def turning_object(filepath, scale, csv_rotations):
             # write all label as csv row in the file created
             writer.writerow(row)
     print("Labels saved in {:.2f} seconds".format(time.time() - tic))
-    shutil.make_archive(dirpath,"zip", dirpath)
-    shutil.rmtree(dirpath)
+    if archive:
+        tic = time.time()
+        shutil.make_archive(dirpath,"zip", dirpath)
+        shutil.rmtree(dirpath)
+        if instrument is not None:
+            instrument.adding_time("render.archive", time.time() - tic)
+            instrument.counting("render.archive_bytes", os.path.getsize(dirpath + ".zip"))
+    if instrument is not None:
+        instrument.writing()
     print("Generation Finished!")
 
-def render_save_img():
+def render_save_img(cache_folder=None):
     """
     Gets all different stl files, Sets different scales in array and
     for each file and each scale creates new scene and renders every rotated images
+
+    cache_folder : folder of the render cache, None to render every image
     """
+    cache = RenderCache(cache_folder) if cache_folder else None
     # path of our stl files
     filepath = "/Users/jouffroy/Desktop/CEA_teletravail/espace/stl"
     # path of the file "rotations_csv.csv"
@@ -264,11 +352,7 @@ def render_save_img():
     # set different scales
     for file in files:
         # for each different stl
-        if(file.split("/")[-1] == "tore_parallelogramme_360.stl"):
-            scales = [1]
-        else: 
-            scales = [1, 0.8, 0.5]
-        for scale in scales:
+        for scale in stl_scales(file):
             # initialize scene
             reinitialization()
             # adding new scaled stl
@@ -278,6 +362,37 @@ def render_save_img():
             # adding new light
             addinglight()
             # render and save png of rotated stl
-            turning_object(file, scale, csv_rotations)
-            
-render_save_img()
\ No newline at end of file
+            turning_object(file, scale, csv_rotations, cache=cache)
+
+
+def render_unit(argv):
+    """
+    Renders the unit of render_scheduler.py given by the arguments written after
+    "--" on the command line of blender, the same as the ones of stub_renderer.py:
+    blender -b scene.blend --python generate_database.py -- --stl ... --scale ...
+    --start ... --stop ... --rotations ... --output ... [--cache ...] [--shard-size ...]
+    [--metrics ...]
+    """
+    parser = unit_parser("Renders a unit with Blender")
+    parser.add_argument("--metrics", default=None,
+                        help="json lines file where the measures of the unit are appended")
+    args = parser.parse_args(argv)
+    cache = RenderCache(args.cache) if args.cache else None
+    instrument = None
+    if args.metrics is not None:
+        # the units of a run can append their snapshots to the same file
+        instrument = Instrumentation(args.metrics, interval=60.,
+                                     labels={"stl": args.stl, "scale": args.scale,
+                                             "start": args.start, "stop": args.stop})
+    reinitialization()
+    addingstl(args.stl, float(args.scale))
+    addingcamera()
+    addinglight()
+    turning_object(args.stl, args.scale, args.rotations, args.start, args.stop, args.output,
+                   archive=False, cache=cache, shard_size=args.shard_size, instrument=instrument)
+
+
+if "--" in sys.argv:
+    render_unit(sys.argv[sys.argv.index("--") + 1:])
+else:
+    render_save_img()
\ No newline at end of file
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+## This module collects the measures of a long run (a walk of creating_space.py
+## or the rendering of generate_database.py): the time spent in every stage, the
+## counters of events, the last values of gauges and the histograms of values
+## observed at every step, such as the score and the angle of the steps of the
+## walk or the render time of the frames. They are written as json lines, one
+## snapshot of every measure per line, so that a run can be followed while it
+## is running:
+##
+##     python creating_space.py --size 100000 --steps 1000000 --metrics walk.jsonl
+##
+## The code measured only holds an Instrumentation when the measures are asked
+## for, and checks `if instrument is not None` before measuring anything.
+
+import bisect, contextlib, json, time
+import numpy as np
+
+# edges of the histograms of the measures of the walk and of the rendering
+HISTOGRAM_EDGES = {
+    # |q_now * transf_prec - q| + |q_now - q|, between 0 and 4
+    "walk.step_score": np.linspace(0, 4, 41),
+    # angle of the transformation of a step, by 5 degrees
+    "walk.step_angle": np.linspace(0, np.pi, 37),
+    "render.frame_seconds": np.geomspace(1e-3, 1e2, 26),
+    "render.frame_bytes": np.geomspace(1e2, 1e6, 21),
+}
+# edges of the histograms of the other measures
+DEFAULT_EDGES = np.geomspace(1e-6, 1e6, 49)
+
+
+class Instrumentation():
+    """
+    This class holds timers (number of calls, total and greatest duration),
+    counters, gauges and histograms of fixed edges (with a bin below the first
+    edge and a bin above the last one), by name. A snapshot of every measure is
+    appended to a json lines file by writing(), and by ticking() once every
+    interval seconds.
+    """
+
+    def __init__(self, path=None, interval=None, labels=None):
+        """
+        path: path of the json lines file of the snapshots, None to keep the
+        measures in memory only
+        interval: number of seconds between two snapshots written by ticking(),
+        None to write them only with writing()
+        labels: dictionary written in every snapshot (stl file, range of frames...)
+        """
+        self.path = path
+        self.interval = interval
+        self.labels = dict(labels or {})
+        self.start = time.perf_counter()
+        self.last_write = self.start
+        self.timers, self.counters, self.gauges, self.histograms = {}, {}, {}, {}
+
+    def counting(self, name, value=1):
+        """
+        Adds value to a counter.
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def setting(self, name, value):
+        """
+        Sets the value of a gauge.
+        """
+        self.gauges[name] = value
+
+    def adding_time(self, name, seconds):
+        """
+        Adds a duration to a timer.
+        """
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = [0, 0., 0.]
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2] = max(timer[2], seconds)
+
+    @contextlib.contextmanager
+    def timing(self, name):
+        """
+        Adds the duration of the block of a with statement to a timer.
+        """
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.adding_time(name, time.perf_counter() - tic)
+
+    def observing(self, name, value):
+        """
+        Adds a value to a histogram, whose edges are given by HISTOGRAM_EDGES.
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            # lists, as a single value is added at a time
+            edges = HISTOGRAM_EDGES.get(name, DEFAULT_EDGES).tolist()
+            histogram = self.histograms[name] = {
+                "edges": edges, "counts": [0] * (len(edges) + 1),
+                "count": 0, "total": 0., "min": float("inf"), "max": float("-inf")}
+        value = float(value)
+        histogram["counts"][bisect.bisect_right(histogram["edges"], value)] += 1
+        histogram["count"] += 1
+        histogram["total"] += value
+        histogram["min"] = min(histogram["min"], value)
+        histogram["max"] = max(histogram["max"], value)
+
+    def snapshot(self):
+        """
+        Returns a dictionary of every measure, that can be saved as json.
+        """
+        timers = {name: {"count": count, "total": total, "mean": total / count, "max": greatest}
+                  for name, (count, total, greatest) in self.timers.items()}
+        histograms = {}
+        for name, histogram in self.histograms.items():
+            count = histogram["count"]
+            histograms[name] = {"edges": list(histogram["edges"]),
+                                "counts": list(histogram["counts"]), "count": count,
+                                "mean": histogram["total"] / count,
+                                "min": histogram["min"], "max": histogram["max"]}
+        return {"time": time.time(), "elapsed": time.perf_counter() - self.start,
+                "labels": self.labels, "timers": timers, "counters": dict(self.counters),
+                "gauges": dict(self.gauges), "histograms": histograms}
+
+    def writing(self):
+        """
+        Appends a snapshot to the json lines file, if any, in a single write so
+        that several processes can share the file.
+        """
+        self.last_write = time.perf_counter()
+        if self.path is None:
+            return
+        # without buffer, the line is not split between several writes
+        with open(self.path, "ab", buffering=0) as outputfile:
+            outputfile.write((json.dumps(self.snapshot()) + "\n").encode())
+
+    def ticking(self):
+        """
+        Writes a snapshot if interval seconds passed since the last one.
+        """
+        if self.interval is not None and time.perf_counter() - self.last_write >= self.interval:
+            self.writing()
+
+
+def reading_snapshots(path):
+    """
+    Returns the snapshots of a json lines file written by Instrumentation, in
+    the order they were written.
+    """
+    snapshots = []
+    with open(path) as inputfile:
+        for line in inputfile:
+            # the last line can be cut if the run was killed
+            try:
+                snapshots.append(json.loads(line))
+            except ValueError:
+                continue
+    return snapshots
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+
+## This module contains a spatial index over the quaternions of a space, so that
+## the walk of Space.find_next_quaternion_array() only scores the quaternions
+## near the positions it is looking for instead of the whole space.
+
+import heapq
+import numpy as np
+from quaternion_kernels import canonicalize, multiply, norm_distance
+
+
+class QuaternionIndex():
+    """
+    This class builds a kd-tree over the quaternions of a space. As q and -q are
+    the same rotation, every quaternion is stored in the hemisphere w >= 0, so
+    that both of them fall in the same cell of the tree. The quaternions can be
+    removed from (and restored in) the index once they are visited.
+    """
+
+    def __init__(self, space_array, leaf_size=64):
+        """
+        space_array: array of shape (n, 4) of quaternions evenly distributed in hypersphere
+        leaf_size: maximal number of quaternions in a leaf of the tree
+        """
+        self.space_array = np.ascontiguousarray(space_array, dtype=float)
+        self.leaf_size = leaf_size
+        # every quaternion is put in the hemisphere w >= 0
+        canonical = canonicalize(self.space_array)
+        # the tree is stored in arrays, the quaternions of a node being the
+        # slice [start, end) of self.order
+        self.order = np.arange(len(canonical))
+        self.lower, self.upper = [], []
+        self.start, self.end = [], []
+        self.children, self.parent = [], []
+        self.building_node(canonical, 0, len(canonical), -1)
+        self.lower, self.upper = np.array(self.lower), np.array(self.upper)
+        self.start, self.end = np.array(self.start), np.array(self.end)
+        self.parent = np.array(self.parent)
+        # quaternions of the space in the order of the tree, with their sign
+        self.rows = self.space_array[self.order]
+        self.leaf_of = np.empty(len(self.order), dtype=int)
+        for node, children in enumerate(self.children):
+            if children is None:
+                self.leaf_of[self.order[self.start[node]:self.end[node]]] = node
+        self.alive = np.ones(len(self.order), dtype=bool)
+        self.alive_count = self.end - self.start
+
+    def building_node(self, canonical, start, end, parent):
+        """
+        Adds the node containing the quaternions order[start:end] to the tree, and
+        splits it along its widest axis until there are at most self.leaf_size
+        quaternions in a leaf. Returns the number of the node.
+        """
+        node = len(self.start)
+        points = canonical[self.order[start:end]]
+        self.lower.append(points.min(axis=0) if len(points) else np.zeros(4))
+        self.upper.append(points.max(axis=0) if len(points) else np.zeros(4))
+        self.start.append(start)
+        self.end.append(end)
+        self.parent.append(parent)
+        self.children.append(None)
+        self.splitting(canonical, node)
+        return node
+
+    def splitting(self, canonical, node):
+        """
+        Splits a leaf holding more than self.leaf_size quaternions in two nodes,
+        along the widest axis of its box.
+        """
+        start, end = self.start[node], self.end[node]
+        if end - start > self.leaf_size:
+            points = canonical[self.order[start:end]]
+            axis = np.argmax(self.upper[node] - self.lower[node])
+            middle = (end - start) // 2
+            split = np.argpartition(points[:, axis], middle)
+            self.order[start:end] = self.order[start:end][split]
+            left = self.building_node(canonical, start, start + middle, node)
+            right = self.building_node(canonical, start + middle, end, node)
+            self.children[node] = (left, right)
+
+    def remove(self, index):
+        """
+        Removes the quaternion space_array[index] from the index.
+        """
+        if self.alive[index]:
+            self.alive[index] = False
+            self.updating_count(index, -1)
+
+    def restore(self, index):
+        """
+        Puts back in the index the quaternion space_array[index] removed before.
+        """
+        if not self.alive[index]:
+            self.alive[index] = True
+            self.updating_count(index, 1)
+
+    def updating_count(self, index, step):
+        """
+        Adds step to the number of quaternions alive of every node containing
+        the quaternion space_array[index].
+        """
+        node = self.leaf_of[index]
+        while node != -1:
+            self.alive_count[node] += step
+            node = self.parent[node]
+
+    def add(self, rows):
+        """
+        Adds quaternions at the end of the space of the index without building
+        the tree again: every quaternion goes down to the leaf whose box is the
+        nearest, enlarging the boxes and the counts of the nodes on its way, and
+        the leaves holding more than self.leaf_size quaternions are split.
+        Returns the indexes of the quaternions added.
+
+        rows: array of shape (m, 4) of quaternions
+        """
+        rows = np.ascontiguousarray(rows, dtype=float).reshape(-1, 4)
+        ids = np.arange(len(self.space_array), len(self.space_array) + len(rows))
+        self.space_array = np.concatenate([self.space_array, rows])
+        canonical = canonicalize(rows)
+        left = np.array([-1 if children is None else children[0] for children in self.children])
+        right = np.array([-1 if children is None else children[1] for children in self.children])
+        # the quaternions go down from the root, one level of the tree at a time
+        leaves = np.zeros(len(rows), dtype=int)
+        moving = np.arange(len(rows))
+        while len(moving):
+            nodes, points = leaves[moving], canonical[moving]
+            np.minimum.at(self.lower, nodes, points)
+            np.maximum.at(self.upper, nodes, points)
+            np.add.at(self.alive_count, nodes, 1)
+            inner = left[nodes] != -1
+            moving, nodes, points = moving[inner], nodes[inner], points[inner]
+            gaps = []
+            for child in (left[nodes], right[nodes]):
+                gap = np.maximum(self.lower[child] - points, points - self.upper[child])
+                gaps.append((np.maximum(gap, 0) ** 2).sum(axis=1))
+            leaves[moving] = np.where(gaps[1] < gaps[0], right[nodes], left[nodes])
+        # the quaternions are inserted at the end of the slice of their leaf, the
+        # slices of the nodes after them being shifted
+        positions = self.end[leaves]
+        self.order = np.insert(self.order, positions, ids)
+        positions = np.sort(positions)
+        self.start = self.start + np.searchsorted(positions, self.start, side="right")
+        self.end = self.end + np.searchsorted(positions, self.end, side="right")
+        self.alive = np.concatenate([self.alive, np.ones(len(rows), dtype=bool)])
+        self.leaf_of = np.concatenate([self.leaf_of, leaves])
+        full = np.unique(leaves[(self.end - self.start)[leaves] > self.leaf_size])
+        if len(full):
+            self.splitting_leaves(full)
+        self.rows = self.space_array[self.order]
+        return ids
+
+    def splitting_leaves(self, leaves):
+        """
+        Splits the leaves holding more than self.leaf_size quaternions after
+        add(), and computes the counts of the new nodes.
+        """
+        first = len(self.start)
+        canonical = canonicalize(self.space_array)
+        self.lower, self.upper = list(self.lower), list(self.upper)
+        self.start, self.end = self.start.tolist(), self.end.tolist()
+        self.parent = self.parent.tolist()
+        for leaf in leaves:
+            self.splitting(canonical, leaf)
+        self.lower, self.upper = np.array(self.lower), np.array(self.upper)
+        self.start, self.end = np.array(self.start), np.array(self.end)
+        self.parent = np.array(self.parent)
+        counts = [np.count_nonzero(self.alive[self.order[start:end]])
+                  for start, end in zip(self.start[first:], self.end[first:])]
+        self.alive_count = np.concatenate([self.alive_count, np.array(counts, dtype=int)])
+        for node in range(first, len(self.start)):
+            if self.children[node] is None:
+                self.leaf_of[self.order[self.start[node]:self.end[node]]] = node
+
+    def lower_bounds(self, nodes, targets):
+        """
+        Returns, for every node, a lower bound of |targets[0] - q| + |targets[1] - q|
+        for every quaternion q of the node, whatever the sign of q.
+
+        nodes: array of numbers of nodes
+        targets: array of shape (2, 2, 4) of the targets and their opposite
+        """
+        # the quaternions of the nodes are compared to the targets and their
+        # opposite, with the axes (node, sign, target, component)
+        gap = np.maximum(self.lower[nodes, np.newaxis, np.newaxis] - targets,
+                         targets - self.upper[nodes, np.newaxis, np.newaxis])
+        np.maximum(gap, 0, out=gap)
+        gap *= gap
+        bounds = np.sqrt(gap.sum(axis=3)).sum(axis=2).min(axis=1)
+        # the bounds are slightly lowered so that the rounding errors never prune
+        # a node containing one of the best quaternions
+        return bounds - 1e-9
+
+    def searching(self, targets, scoring, k, exclude=None):
+        """
+        Returns the indexes and the scores of the k quaternions alive with the
+        lowest scores, ordered by score then by index. The tree is browsed from
+        the nodes with the lowest bound, and stops once no node can hold a
+        better quaternion.
+
+        targets: array of shape (2, 4) such as the score of q is greater than
+        |targets[0] - q| + |targets[1] - q|
+        scoring: function returning the scores of an array of quaternions
+        k: number of quaternions returned
+        exclude: index of a quaternion that can not be returned
+        """
+        best = []
+        targets = np.stack([targets, -targets])
+        nodes = [(self.lower_bounds([0], targets)[0], 0)]
+        while nodes:
+            bound, node = heapq.heappop(nodes)
+            if len(best) == k and bound > -best[0][0]:
+                break
+            children = self.children[node]
+            if children is not None:
+                for bound, child in zip(self.lower_bounds(children, targets), children):
+                    if self.alive_count[child] > 0:
+                        heapq.heappush(nodes, (bound, child))
+                continue
+            ids = self.order[self.start[node]:self.end[node]]
+            keep = self.alive[ids]
+            if exclude is not None:
+                keep &= ids != exclude
+            scores = scoring(self.rows[self.start[node]:self.end[node]][keep])
+            ids = ids[keep]
+            if len(best) == k:
+                # only the quaternions better than the worst of the best are kept
+                better = scores <= -best[0][0]
+                scores, ids = scores[better], ids[better]
+            for score, index in zip(scores, ids):
+                # best is a max-heap on (score, index) of the k best quaternions
+                item = (-score, -index)
+                if len(best) < k:
+                    heapq.heappush(best, item)
+                elif item > best[0]:
+                    heapq.heapreplace(best, item)
+        best.sort(reverse=True)
+        indexes = np.array([-index for _, index in best], dtype=int)
+        scores = np.array([-score for score, _ in best])
+        return indexes, scores
+
+    def query(self, space, q_now, transf_prec, k, exclude=None):
+        """
+        Returns the indexes and the distances of the k best next positions of
+        Space.find_next_quaternion_array(), the same as the ones of the scan of
+        the whole space. As q_now is unitary, the distance of q is equal to
+        |q_now * transf_prec - q| + |q_now - q|, so only the quaternions near
+        these two positions are scored.
+
+        space: Space walking through the quaternions
+        q_now : the quaternion we are now
+        transf_prec : the transformation applied to the previous quaternion to arrive
+        at the actual quaternion q_now
+        k: number of candidates returned
+        exclude: index of q_now in the space, that can not be chosen
+        """
+        q_now, transf_prec = space.components(q_now), space.components(transf_prec)
+        targets = np.array([multiply(q_now, transf_prec), q_now])
+
+        def scoring(rows):
+            # same distance as Space.scoring_quaternions(), the targets being
+            # computed once for all the leaves
+            return norm_distance(rows, targets[0]) + norm_distance(rows, targets[1])
+
+        return self.searching(targets, scoring, k, exclude)
+
+    def locating(self, canonical):
+        """
+        Returns, for every quaternion of the hemisphere w >= 0, the leaf reached
+        by going down from the root to the child whose box is the nearest.
+
+        canonical: array of shape (m, 4) of quaternions with w >= 0
+        """
+        left = np.array([-1 if children is None else children[0] for children in self.children])
+        right = np.array([-1 if children is None else children[1] for children in self.children])
+        leaves = np.zeros(len(canonical), dtype=int)
+        moving = np.flatnonzero(left[leaves] != -1)
+        while len(moving):
+            nodes, points = leaves[moving], canonical[moving]
+            gaps = []
+            for child in (left[nodes], right[nodes]):
+                gap = np.maximum(self.lower[child] - points, points - self.upper[child])
+                gaps.append((np.maximum(gap, 0) ** 2).sum(axis=1))
+            leaves[moving] = np.where(gaps[1] < gaps[0], right[nodes], left[nodes])
+            moving = moving[left[leaves[moving]] != -1]
+        return leaves
+
+    def nearest(self, points, exclude=None):
+        """
+        Returns, for every rotation of points, the index of the quaternion alive
+        nearest to it and their distance min(|q - p|, |q + p|) (q and -q being
+        the same rotation), inf if there is none. The points are processed by
+        groups falling in the same leaf: the distance to the nearest quaternion
+        of their leaf bounds the leaves whose box (or its opposite) can hold a
+        nearer one, which are found for every group at once by going down the
+        tree, and only these leaves are compared to the group.
+
+        points: array of shape (m, 4) of unitary quaternions
+        exclude: array of m indexes of quaternions that can not be returned for
+        the points (the point itself, to find the nearest other quaternion)
+        """
+        points = np.ascontiguousarray(points, dtype=float).reshape(-1, 4)
+        canonical = canonicalize(points)
+        home = self.locating(canonical)
+        by_leaf = np.argsort(home, kind="stable")
+        leaves, firsts = np.unique(home[by_leaf], return_index=True)
+        groups = np.split(by_leaf, firsts[1:])
+        # box of every group, and bound of the distance of its points to the
+        # nearest quaternion, from the quaternions of their leaf
+        low = np.minimum.reduceat(canonical[by_leaf], firsts)
+        high = np.maximum.reduceat(canonical[by_leaf], firsts)
+        bounds = np.full(len(groups), np.inf)
+        for g, (leaf, group) in enumerate(zip(leaves, groups)):
+            if self.alive_count[leaf]:
+                bounds[g] = self.comparing(points[group], [leaf], exclude, group)[1].max()
+        # couples (group, node) of the nodes which can hold a nearer quaternion,
+        # one level of the tree at a time
+        left = np.array([-1 if children is None else children[0] for children in self.children])
+        right = np.array([-1 if children is None else children[1] for children in self.children])
+        pairs_group, pairs_node = np.arange(len(groups)), np.zeros(len(groups), dtype=int)
+        found_group, found_leaf = [], []
+        while len(pairs_group):
+            lower, upper = self.lower[pairs_node], self.upper[pairs_node]
+            gap = np.maximum(np.maximum(lower - high[pairs_group], low[pairs_group] - upper), 0)
+            # the opposite of the quaternions of the node are in the box [-upper, -lower]
+            opposite = np.maximum(np.maximum(-upper - high[pairs_group], low[pairs_group] + lower), 0)
+            gap = np.minimum((gap * gap).sum(axis=1), (opposite * opposite).sum(axis=1))
+            keep = ((np.sqrt(gap) <= bounds[pairs_group] + 1e-9)
+                    & (self.alive_count[pairs_node] > 0))
+            pairs_group, pairs_node = pairs_group[keep], pairs_node[keep]
+            leaf = left[pairs_node] == -1
+            found_group.append(pairs_group[leaf])
+            found_leaf.append(pairs_node[leaf])
+            pairs_group = np.repeat(pairs_group[~leaf], 2)
+            pairs_node = np.stack([left[pairs_node[~leaf]], right[pairs_node[~leaf]]], axis=1).ravel()
+        found_group, found_leaf = np.concatenate(found_group), np.concatenate(found_leaf)
+        candidates = np.split(found_leaf[np.argsort(found_group, kind="stable")],
+                              np.cumsum(np.bincount(found_group, minlength=len(groups)))[:-1])
+        indexes = np.full(len(points), -1)
+        distances = np.full(len(points), np.inf)
+        for group, leaves in zip(groups, candidates):
+            if len(leaves):
+                indexes[group], distances[group] = self.comparing(points[group], leaves,
+                                                                   exclude, group)
+        return indexes, distances
+
+    def comparing(self, points, leaves, exclude=None, group=None):
+        """
+        Returns, for every point, the index of the quaternion alive of the leaves
+        nearest to it, and their distance (inf if there is none).
+        """
+        ids = np.concatenate([self.order[self.start[leaf]:self.end[leaf]] for leaf in leaves])
+        ids = ids[self.alive[ids]]
+        if not len(ids):
+            return np.full(len(points), -1), np.full(len(points), np.inf)
+        rows = self.space_array[ids]
+        # as the quaternions are unitary, min(|q - p|, |q + p|)² = 2 - 2|q.p|, so
+        # that the nearest one is the one of greatest |q.p|, found by a product
+        # of matrices
+        dots = np.abs(points @ rows.T)
+        if exclude is not None:
+            dots[ids == exclude[group][:, np.newaxis]] = -np.inf
+        best = dots.argmax(axis=1)
+        found = np.isfinite(dots[np.arange(len(points)), best])
+        nearest = rows[best]
+        distances = np.minimum(np.linalg.norm(points - nearest, axis=1),
+                               np.linalg.norm(points + nearest, axis=1))
+        return np.where(found, ids[best], -1), np.where(found, distances, np.inf)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+## This module contains the operations on quaternions used by the walk, computed
+## on arrays of shape (..., 4) of the components (w,x,y,z), in the order of
+## quaternion.as_float_array(). One quaternion of shape (4,) is broadcast against
+## an array of shape (n, 4), so that a whole space is processed in one call
+## instead of one np.quaternion object at a time. The products and the norms are
+## computed by the compiled loops of numpy-quaternion on a view of the arrays,
+## which is not a copy when their rows are contiguous.
+
+import numpy as np
+# numpy-quaternion registers the dtype np.quaternion
+import quaternion
+
+
+def as_quaternions(q):
+    """
+    Returns an array of quaternions of shape (..., 4) as an array of
+    np.quaternion of shape (...), sharing the memory of q when its rows are
+    contiguous.
+    """
+    return np.ascontiguousarray(q, dtype=float).view(np.quaternion)[..., 0]
+
+
+def as_components(q):
+    """
+    Returns an array of np.quaternion of shape (...) as an array of floats of
+    shape (..., 4), without copy.
+    """
+    return np.asarray(q)[..., np.newaxis].view(float)
+
+
+def multiply(p, q):
+    """
+    Returns the Hamilton product p*q of two arrays of quaternions.
+    """
+    return as_components(as_quaternions(p) * as_quaternions(q))
+
+
+def conjugate(q):
+    """
+    Returns the conjugates (w,-x,-y,-z) of an array of quaternions.
+    """
+    return np.asarray(q, dtype=float) * np.array([1., -1., -1., -1.])
+
+
+def inverse(q):
+    """
+    Returns the inverses of an array of quaternions.
+    """
+    return as_components(np.reciprocal(as_quaternions(q)))
+
+
+def relative_transform(q1, q2):
+    """
+    Returns the quaternions of the transformations applied to q1 to obtain q2,
+    that is q1^-1 * q2.
+    """
+    return as_components(np.reciprocal(as_quaternions(q1)) * as_quaternions(q2))
+
+
+def norm_distance(p, q):
+    """
+    Returns the norms |p - q| of the differences of two arrays of quaternions.
+    """
+    return np.abs(as_quaternions(p) - as_quaternions(q))
+
+
+def geodesic_angle(p, q):
+    """
+    Returns the angles (in radians) of the rotations leading from the unitary
+    quaternions p to the unitary quaternions q, q and -q being the same rotation.
+    """
+    dots = np.abs((np.asarray(p, dtype=float) * np.asarray(q, dtype=float)).sum(axis=-1))
+    return 2 * np.arccos(np.minimum(dots, 1.))
+
+
+def canonicalize(q):
+    """
+    Returns the quaternions of the same rotations in the hemisphere w >= 0.
+    """
+    q = np.asarray(q, dtype=float)
+    return np.where(q[..., :1] < 0, -q, q)
+
+
+def rotation_matrices(q):
+    """
+    Returns the matrices of shape (..., 3, 3) of the rotations of an array of
+    quaternions, which are normalized first, as Blender does with the
+    rotation_quaternion of an object.
+    """
+    q = np.asarray(q, dtype=float)
+    w, x, y, z = np.moveaxis(q / np.linalg.norm(q, axis=-1, keepdims=True), -1, 0)
+    return np.stack([np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)], axis=-1),
+                     np.stack([2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)], axis=-1),
+                     np.stack([2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)], axis=-1)],
+                    axis=-2)
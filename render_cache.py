@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+## This module contains a cache of the rendered images, so that a frame is not
+## rendered again when the stl file, the scale, the render settings and the
+## rotation did not change since the last build of the database.
+
+import collections, hashlib, json, os, shutil, uuid
+import numpy as np
+
+
+class RenderCache():
+    """
+    This class stores the rendered png files in a folder, under the hash of
+    everything that changes the image: the content and the name of the stl file,
+    the scale, the render settings and the quaternion, rounded so that the
+    rounding errors of the walk do not change the key (q and -q being the same
+    rotation). When the folder is bigger than max_bytes, the images used the
+    least recently are removed. Several processes can share the folder: the
+    limit applies to the whole folder, which is listed again once a process
+    wrote a sixteenth of max_bytes since it last listed it, so that the images
+    written by the other processes are counted. The folder can exceed max_bytes
+    by at most a sixteenth of it per process.
+    """
+
+    def __init__(self, folder, max_bytes=2**30, decimals=6):
+        """
+        folder: folder of the images of the cache
+        max_bytes: greatest size of the images of the cache
+        decimals: number of decimals of the quaternions kept in the key
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.decimals = decimals
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.stl_hashes = {}
+        os.makedirs(folder, exist_ok=True)
+        self.scanning()
+
+    def scanning(self):
+        """
+        Lists the images of the folder, ordered from the one used the least
+        recently, with their sizes.
+        """
+        # the images modified at the same time (the times of the files being
+        # coarse) keep the order in which this process used them
+        rank = {key: i for i, key in enumerate(getattr(self, "entries", ()))}
+        entries = []
+        for name in os.listdir(self.folder):
+            if name.endswith(".png"):
+                try:
+                    status = os.stat(os.path.join(self.folder, name))
+                except FileNotFoundError:
+                    # the image was removed by another process sharing the cache
+                    continue
+                entries.append((status.st_mtime, rank.get(name[:-4], -1), name[:-4], status.st_size))
+        self.entries = collections.OrderedDict((key, size) for _, _, key, size in sorted(entries))
+        self.size = sum(self.entries.values())
+        # bytes stored by this process since the folder was listed
+        self.written = 0
+
+    def hashing_stl(self, filepath):
+        """
+        Returns the hash of the content of an stl file, computed once per file.
+        """
+        if filepath not in self.stl_hashes:
+            digest = hashlib.sha256()
+            with open(filepath, "rb") as inputfile:
+                for block in iter(lambda: inputfile.read(1 << 20), b""):
+                    digest.update(block)
+            self.stl_hashes[filepath] = digest.hexdigest()
+        return self.stl_hashes[filepath]
+
+    def key(self, filepath, scale, settings, rotation):
+        """
+        Returns the key of the image of an stl file rendered with a rotation.
+
+        filepath: path of the stl file
+        scale: scale of the stl file
+        settings: dictionary of the render settings (resolution, Eevee, camera, light)
+        rotation: quaternion (w,x,y,z)
+        """
+        rotation = np.asarray(rotation, dtype=float)[:4]
+        if rotation[0] < 0:
+            rotation = -rotation
+        # adding 0. turns -0. into 0.
+        rotation = np.round(rotation, self.decimals) + 0.
+        content = json.dumps([self.hashing_stl(filepath), os.path.basename(filepath), str(scale),
+                              settings, rotation.tolist()], sort_keys=True)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def path(self, key):
+        """
+        Returns the path of the image of a key in the cache.
+        """
+        return os.path.join(self.folder, key + ".png")
+
+    def get(self, key, destination):
+        """
+        Copies the image of the key to destination if it is in the cache. Returns
+        True if it was found.
+        """
+        if key in self.entries:
+            try:
+                shutil.copyfile(self.path(key), destination)
+                os.utime(self.path(key))
+            except FileNotFoundError:
+                if os.path.exists(self.path(key)):
+                    # the destination can not be written, which is not a miss
+                    raise
+                # the image was removed by another process sharing the cache
+                self.size -= self.entries.pop(key)
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True
+        self.misses += 1
+        return False
+
+    def put(self, key, source):
+        """
+        Copies the image rendered in source to the cache, then removes the images
+        used the least recently until the cache fits in max_bytes.
+        """
+        if key in self.entries:
+            self.size -= self.entries.pop(key)
+        # the image is renamed at once, so that it is never read partially
+        # written, from a temporary file of its own, as several processes can
+        # store the same image at the same time
+        temporary = "{}.{}.tmp".format(self.path(key), uuid.uuid4().hex)
+        try:
+            shutil.copyfile(source, temporary)
+            os.replace(temporary, self.path(key))
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        self.entries[key] = os.path.getsize(source)
+        self.size += self.entries[key]
+        self.written += self.entries[key]
+        if self.size > self.max_bytes or self.written >= self.max_bytes / 16:
+            # the images written by the other processes are counted too
+            self.scanning()
+            # the image just stored is kept, as the most recent one
+            self.entries.move_to_end(key)
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            oldest, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(oldest))
+            except FileNotFoundError:
+                # already removed by another process sharing the cache
+                pass
+
+    def stats(self):
+        """
+        Returns the numbers of hits, misses and evictions, the rate of hits, and
+        the number and the size of the images of the cache.
+        """
+        requests = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests else 0.,
+                "entries": len(self.entries), "bytes": self.size}
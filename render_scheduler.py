@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+
+## This script splits the rendering of the database into units of work (stl file,
+## scale, range of frames) and runs them on several renderer processes, such as
+## `blender -b scene.blend --python generate_database.py -- ...`. The units
+## finished are written in a manifest, so that an interrupted run resumes from
+## the units which were not finished.
+
+import argparse, csv, glob, json, os, shutil, struct, subprocess, sys, threading, zlib
+import concurrent.futures
+import numpy as np
+from rotations_io import load_rotations
+from render_cache import RenderCache
+from shard_writer import ShardWriter
+
+
+def stl_scales(filepath):
+    """
+    Returns the scales rendered for an stl file: the tore is only rendered at
+    its own scale.
+    """
+    if os.path.basename(filepath) == "tore_parallelogramme_360.stl":
+        return [1]
+    return [1, 0.8, 0.5]
+
+
+def stl_name(filepath, scale):
+    """
+    Returns the name of the folder (and of the archive) of an stl file at a scale.
+    """
+    return os.path.splitext(os.path.basename(filepath))[0] + "_" + str(scale)
+
+
+def unit_labels(dirpath, name, start, stop):
+    """
+    Returns the path of the labels file written by the unit rendering the
+    frames [start, stop) of the folder dirpath.
+    """
+    return os.path.join(dirpath, "{}_directory_labels_{}_{}.csv".format(name, start, stop))
+
+
+def unit_parser(description):
+    """
+    Returns the parser of the arguments of a unit given by RenderScheduler to
+    the renderer, to which a renderer can add its own options.
+
+    description: description of the renderer
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--stl", required=True, help="path of the stl file")
+    # the scale is kept as written by the scheduler, which names the folders with it
+    parser.add_argument("--scale", required=True, help="scale of the stl file")
+    parser.add_argument("--start", type=int, required=True, help="number of the first frame")
+    parser.add_argument("--stop", type=int, required=True, help="number after the last frame")
+    parser.add_argument("--rotations", required=True, help="rotations file, csv or .npy")
+    parser.add_argument("--output", required=True, help="folder of the stl files rendered")
+    parser.add_argument("--cache", default=None, help="folder of the render cache")
+    parser.add_argument("--shard-size", type=int, default=None,
+                        help="writes the frames in tar shards of this number of frames")
+    return parser
+
+
+def writing_labels(path, dimensions, rotations, start=0):
+    """
+    Writes a labels file as generate_database.py: the header and the values of
+    the dimensions of the stl file, then the number and the quaternion of every
+    frame.
+
+    path: path of the labels file
+    dimensions: dimensions of the stl file on the x, y and z axis
+    rotations: rotations of the frames, the quaternion (w,x,y,z) being the first four values
+    start: number of the first frame
+    """
+    with open(path, "w") as outputfile:
+        writer = csv.writer(outputfile)
+        writer.writerow(["dimension_x", "dimension_y", "dimension_z"])
+        writer.writerow(dimensions)
+        writer.writerow(["number_image", "transformation applied from precedent image"])
+        for i, rotation in enumerate(rotations, start):
+            writer.writerow((i, rotation[:4].tolist()))
+
+
+def png_bytes(image):
+    """
+    Returns the bytes of a grayscale png of an array of uint8 of shape (height, width).
+    """
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data
+                + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+    height, width = image.shape
+    # every row begins with the byte of its filter
+    rows = np.concatenate([np.zeros((height, 1), dtype=np.uint8), image], axis=1)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows.tobytes())) + chunk(b"IEND", b""))
+
+
+def running_unit(args, settings, rendering, dimensions, batch_size=1):
+    """
+    Renders the frames of a unit given by RenderScheduler to a renderer without
+    Blender, as generate_database.py does: the frames already in the shards of
+    an interrupted run are skipped, the frames in the render cache are copied
+    from it, and the other ones are rendered by batches. Then the labels of the
+    unit are written, unless the frames and their labels are in shards.
+
+    args: arguments of the unit, parsed by unit_parser()
+    settings: render settings of the renderer, part of the key of the images in the cache
+    rendering: function returning the images, as arrays of uint8 of shape
+    (height, width), of an array of shape (m, 4) of quaternions
+    dimensions: dimensions of the stl file on the x, y and z axis
+    batch_size: greatest number of frames given at once to rendering
+    """
+    name = stl_name(args.stl, args.scale)
+    dirpath = os.path.join(args.output, name)
+    os.makedirs(dirpath, exist_ok=True)
+    cache = RenderCache(args.cache) if args.cache else None
+    rotations = load_rotations(args.rotations, args.start, args.stop)
+    shards, written = None, set()
+    if args.shard_size is not None:
+        shards = ShardWriter(dirpath, "{}_{}".format(name, args.start), args.shard_size)
+        written = shards.written_keys()
+    for first in range(args.start, args.start + len(rotations), batch_size):
+        numbers = [i for i in range(first, min(first + batch_size, args.start + len(rotations)))
+                   if "frame_{:08d}".format(i) not in written]
+        framepaths = {i: os.path.join(dirpath, "frame_{}.png".format(i)) for i in numbers}
+        keys = {}
+        if cache is not None:
+            keys = {i: cache.key(args.stl, args.scale, settings, rotations[i - args.start])
+                    for i in numbers}
+        # only the frames which are not in the cache are rendered, all at once
+        missing = [i for i in numbers if cache is None or not cache.get(keys[i], framepaths[i])]
+        if missing:
+            images = rendering(np.asarray(rotations)[np.array(missing) - args.start, :4])
+            for i, image in zip(missing, images):
+                with open(framepaths[i], "wb") as outputfile:
+                    outputfile.write(png_bytes(image))
+                if cache is not None:
+                    cache.put(keys[i], framepaths[i])
+        if shards is not None:
+            # the frames are moved from their files to the shard with their label
+            for i in numbers:
+                with open(framepaths[i], "rb") as inputfile:
+                    shards.write("frame_{:08d}".format(i), inputfile.read(),
+                                 {"number_image": i,
+                                  "rotation": rotations[i - args.start][:4].tolist(),
+                                  "stl": os.path.splitext(os.path.basename(args.stl))[0],
+                                  "scale": float(args.scale), "dimensions": dimensions})
+                os.remove(framepaths[i])
+    if cache is not None:
+        print("Render cache: {}".format(cache.stats()))
+    if shards is not None:
+        # the labels are already in the shards
+        shards.close()
+    else:
+        writing_labels(unit_labels(dirpath, name, args.start, args.stop), dimensions,
+                       rotations, args.start)
+
+
+def merging_labels(dirpath, name, ranges):
+    """
+    Writes the labels file of a folder from the labels files of its units, which
+    all begin with the same three rows (header and values of the dimensions, and
+    header of the rotations), and removes them. The labels file is renamed once
+    complete, so that if it exists, the labels were already merged by an
+    interrupted run and nothing is done.
+
+    dirpath: folder of the frames
+    name: name of the stl file with its scale
+    ranges: list of the ranges (start, stop) of the units, in the order of the frames
+    """
+    path = os.path.join(dirpath, name + "_directory_labels.csv")
+    if os.path.exists(path):
+        return
+    with open(path + ".tmp", "w") as outputfile:
+        for i, (start, stop) in enumerate(ranges):
+            with open(unit_labels(dirpath, name, start, stop)) as inputfile:
+                lines = inputfile.readlines()
+            outputfile.writelines(lines if i == 0 else lines[3:])
+    os.replace(path + ".tmp", path)
+    for start, stop in ranges:
+        os.remove(unit_labels(dirpath, name, start, stop))
+
+
+class RenderScheduler():
+    """
+    This class runs the units of the rendering of the database on a pool of
+    renderer processes. A unit is run by the command
+    `command --stl <stl> --scale <scale> --start <start> --stop <stop>
+    --rotations <rotations> --output <output> [--cache <cache>]`, which renders
+    the frames of the unit in <output>/<stl>_<scale> and writes the labels of
+    these frames. Once
+    every unit of an stl file at a scale is finished, the labels are merged and
+    the folder is archived.
+    """
+
+    def __init__(self, stl_files, rotations, output, command, frames_per_unit=1000,
+                 workers=2, manifest=None, cache=None, shard_size=None):
+        """
+        stl_files: paths of the stl files
+        rotations: path of the rotations file, csv or .npy
+        output: folder of the archives
+        command: list of the arguments of the renderer, before the arguments of the unit
+        frames_per_unit: number of frames rendered by a unit
+        workers: number of renderer processes run at once
+        manifest: path of the manifest of the units finished, in output by default
+        cache: folder of the render cache given to the renderer, if any
+        shard_size: if given, the renderer writes the frames in tar shards of
+        shard_size frames, which are not archived afterwards
+        """
+        self.stl_files = sorted(stl_files)
+        self.rotations = rotations
+        self.output = output
+        self.command = list(command)
+        self.frames_per_unit = frames_per_unit
+        self.workers = workers
+        self.manifest = manifest or os.path.join(output, "render_manifest.jsonl")
+        self.cache = cache
+        self.shard_size = shard_size
+        self.lock = threading.Lock()
+
+    def units(self):
+        """
+        Returns the list of the units (stl file, scale, start, stop) of the database.
+        """
+        nb_frames = len(load_rotations(self.rotations))
+        return [(stl, scale, start, min(start + self.frames_per_unit, nb_frames))
+                for stl in self.stl_files for scale in stl_scales(stl)
+                for start in range(0, nb_frames, self.frames_per_unit)]
+
+    def finished(self):
+        """
+        Returns the set of the units (and of the archives, as (stl, scale)) written
+        in the manifest.
+        """
+        done = set()
+        if os.path.exists(self.manifest):
+            with open(self.manifest) as inputfile:
+                for line in inputfile:
+                    # the last line can be cut if the scheduler was killed
+                    try:
+                        done.add(tuple(json.loads(line)["unit"]))
+                    except ValueError:
+                        continue
+        return done
+
+    def recording(self, unit):
+        """
+        Appends a unit finished to the manifest.
+        """
+        line = (json.dumps({"unit": list(unit)}) + "\n").encode()
+        with self.lock:
+            with open(self.manifest, "ab+") as outputfile:
+                # a line cut by a kill is ended first, so that it does not swallow
+                # the unit recorded after it
+                size = outputfile.seek(0, os.SEEK_END)
+                if size:
+                    outputfile.seek(size - 1)
+                    if outputfile.read(1) != b"\n":
+                        line = b"\n" + line
+                outputfile.write(line)
+                outputfile.flush()
+                os.fsync(outputfile.fileno())
+
+    def rendering(self, unit):
+        """
+        Runs the renderer on a unit and records it in the manifest once it succeeded.
+        """
+        stl, scale, start, stop = unit
+        arguments = ["--stl", stl, "--scale", str(scale), "--start", str(start), "--stop", str(stop),
+                     "--rotations", self.rotations, "--output", self.output]
+        if self.cache is not None:
+            arguments += ["--cache", self.cache]
+        if self.shard_size is not None:
+            arguments += ["--shard-size", str(self.shard_size)]
+        subprocess.run(self.command + arguments, check=True)
+        self.recording(unit)
+        return unit
+
+    def archiving(self, stl, scale, ranges):
+        """
+        Merges the labels of the units of an stl file at a scale, archives its
+        folder and records the archive in the manifest. Every step can be run
+        again after an interruption: the archive is written under a temporary
+        name and renamed once complete, and the folder is only removed after.
+        """
+        name = stl_name(stl, scale)
+        dirpath = os.path.join(self.output, name)
+        if os.path.isdir(dirpath):
+            merging_labels(dirpath, name, ranges)
+            shutil.make_archive(dirpath + ".tmp", "zip", dirpath)
+            os.replace(dirpath + ".tmp.zip", dirpath + ".zip")
+            shutil.rmtree(dirpath)
+        self.recording((stl, scale))
+
+    def run(self):
+        """
+        Runs every unit not finished yet, then archives every stl file at a scale
+        whose units are all finished. Returns the number of units run.
+        """
+        os.makedirs(self.output, exist_ok=True)
+        units = self.units()
+        done = self.finished()
+        pending = [unit for unit in units if unit not in done]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # every thread waits for its renderer process
+            for future in concurrent.futures.as_completed(
+                    [executor.submit(self.rendering, unit) for unit in pending]):
+                future.result()
+        if self.shard_size is not None:
+            # the shards are written complete by the units
+            return len(pending)
+        done = self.finished()
+        for stl in self.stl_files:
+            for scale in stl_scales(stl):
+                ranges = [(start, stop) for s, c, start, stop in units if (s, c) == (stl, scale)]
+                if (stl, scale) not in done and all((stl, scale) + r in done for r in ranges):
+                    self.archiving(stl, scale, ranges)
+        return len(pending)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Renders the database on several processes")
+    parser.add_argument("--stl", default="stl", help="folder of the stl files")
+    parser.add_argument("--rotations", default="rotations_csv.csv", help="rotations file")
+    parser.add_argument("--output", default="dataset", help="folder of the archives")
+    parser.add_argument("--blend", default=None, help="blend file of the scene")
+    parser.add_argument("--blender", default="blender", help="path of the blender executable")
+    parser.add_argument("--stub", action="store_true",
+                        help="renders dummy images with stub_renderer.py instead of Blender")
+    parser.add_argument("--raster", action="store_true",
+                        help="renders the images with stl_raster.py (numpy) instead of Blender")
+    parser.add_argument("--frames-per-unit", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--cache", default=None, help="folder of the render cache")
+    parser.add_argument("--shard-size", type=int, default=None,
+                        help="writes the frames in tar shards of this number of frames")
+    args = parser.parse_args()
+    folder = os.path.dirname(os.path.abspath(__file__))
+    if args.stub:
+        command = [sys.executable, os.path.join(folder, "stub_renderer.py")]
+    elif args.raster:
+        command = [sys.executable, os.path.join(folder, "stl_raster.py")]
+    else:
+        command = [args.blender, "-b"] + ([args.blend] if args.blend else []) + [
+            "--python", os.path.join(folder, "generate_database.py"), "--"]
+    stl_files = glob.glob(os.path.join(args.stl, "**/*.stl"), recursive=True)
+    scheduler = RenderScheduler(stl_files, args.rotations, args.output, command,
+                                args.frames_per_unit, args.workers, cache=args.cache,
+                                shard_size=args.shard_size)
+    print("{} units rendered".format(scheduler.run()))
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+## This module contains the readers and writers of the rotations files used by
+## Blender. The rotations are saved either as csv rows (w,x,y,z), or as a .npy
+## file holding an array of shape (n, 4) of the positions, or (n, 8) of the
+## positions followed by the transformations, that can be memory-mapped.
+
+import itertools, json, os
+import numpy as np
+
+
+def save_rotations(filepath, positions, transformations=None, dtype=np.float64):
+    """
+    Saves the positions (and the transformations) of a walk in a .npy file, or
+    in a csv file if filepath does not end with .npy.
+
+    positions: array of shape (n, 4)
+    transformations: array of shape (n, 4), or None
+    dtype: type of the values of the .npy file (float64 or float32)
+    """
+    rotations = np.asarray(positions)
+    if transformations is not None:
+        rotations = np.concatenate([rotations, np.asarray(transformations)], axis=1)
+    if filepath.endswith(".npy"):
+        np.save(filepath, rotations.astype(dtype, copy=False))
+    else:
+        np.savetxt(filepath, rotations, delimiter=",")
+
+
+def load_rotations(filepath, start=None, stop=None):
+    """
+    Returns the rows [start, stop) of a rotations file. A .npy file is
+    memory-mapped, so that only the rows used are read from the disk; a csv
+    file is parsed up to the row stop.
+
+    filepath: path of the .npy or csv file
+    start: first row returned
+    stop: row after the last one returned, None for the end of the file
+    """
+    if filepath.endswith(".npy"):
+        return np.load(filepath, mmap_mode="r")[start:stop]
+    start = start or 0
+    with open(filepath) as inputfile:
+        lines = list(itertools.islice(inputfile, start, stop))
+    return np.loadtxt(lines, delimiter=",", ndmin=2)
+
+
+def convert_rotations(source, destination, chunk_size=100000, dtype=np.float64):
+    """
+    Converts a rotations file from csv to .npy or from .npy to csv (according to
+    the extension of destination), by chunks of rows.
+
+    source: path of the file to convert
+    destination: path of the file created
+    chunk_size: number of rows converted at once
+    dtype: type of the values of the .npy file
+    """
+    if destination.endswith(".npy"):
+        with open(source) as inputfile:
+            nb_rows = sum(1 for _ in inputfile)
+            inputfile.seek(0)
+            first = np.loadtxt([inputfile.readline()], delimiter=",", ndmin=2)
+            inputfile.seek(0)
+            rotations = np.lib.format.open_memmap(destination, mode="w+", dtype=dtype,
+                                                  shape=(nb_rows, first.shape[1]))
+            for start in range(0, nb_rows, chunk_size):
+                lines = list(itertools.islice(inputfile, chunk_size))
+                rotations[start:start + len(lines)] = np.loadtxt(lines, delimiter=",", ndmin=2)
+            rotations.flush()
+    else:
+        rotations = np.load(source, mmap_mode="r")
+        with open(destination, "wb") as outputfile:
+            for start in range(0, len(rotations), chunk_size):
+                np.savetxt(outputfile, rotations[start:start + chunk_size], delimiter=",")
+
+
+class RotationsWriter():
+    """
+    This class appends rows of quaternions (w,x,y,z) to a csv file by chunks.
+    After each chunk, the number of rows and the size of the file are saved in
+    a state file next to it (with any state given by the caller, such as the
+    state of a random generator), so that a walk interrupted can be resumed
+    from the last chunk written. Used in a with statement, the rows left in the
+    buffer are only written if no exception was raised (a Ctrl-C included).
+    """
+
+    def __init__(self, filepath, buffer_size=10000, with_transformations=False,
+                 state=None, resume=True):
+        """
+        filepath: path of the csv file
+        buffer_size: number of rows kept in memory before being written
+        with_transformations: if True, the transformation is written after the
+        position on every row
+        state: function returning a dictionary saved with every chunk
+        resume: if False, the file is rewritten from the beginning
+        """
+        self.filepath = filepath
+        self.state_path = filepath + ".state"
+        self.buffer_size = buffer_size
+        self.with_transformations = with_transformations
+        self.get_state = state
+        self.buffer = []
+        self.rows, self.offset, self.state = 0, 0, None
+        if resume and os.path.exists(filepath) and os.path.exists(self.state_path):
+            with open(self.state_path) as inputfile:
+                saved = json.load(inputfile)
+            self.rows, self.offset, self.state = saved["rows"], saved["offset"], saved["state"]
+            self.file = open(filepath, "r+b")
+        else:
+            self.file = open(filepath, "wb")
+        # the rows written after the last state saved are not complete
+        self.file.truncate(self.offset)
+        self.file.seek(self.offset)
+
+    def last_rows(self, count=2):
+        """
+        Returns an array with the last rows written in the file (at most count).
+        """
+        size = min(self.offset, 4096)
+        lines = []
+        while size:
+            self.file.seek(self.offset - size)
+            lines = self.file.read(size).splitlines()
+            # the first line read can be cut, unless the beginning of the file is reached
+            if size == self.offset or len(lines) > count:
+                break
+            size = min(self.offset, size * 2)
+        self.file.seek(self.offset)
+        lines = lines[-count:] if size == self.offset else lines[1:][-count:]
+        return np.array([[float(value) for value in line.split(b",")] for line in lines])
+
+    def write(self, position, transformation=None):
+        """
+        Adds a row to the buffer, and writes the buffer in the file once it is full.
+
+        position: array (w,x,y,z) of the position
+        transformation: array (w,x,y,z) of the transformation leading to the position
+        """
+        if self.with_transformations:
+            self.buffer.append(np.concatenate([position, transformation]))
+        else:
+            self.buffer.append(position)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Appends the buffer to the file and saves the state of the writer.
+        """
+        if self.buffer:
+            np.savetxt(self.file, np.array(self.buffer), delimiter=",")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.rows += len(self.buffer)
+            self.offset = self.file.tell()
+            self.buffer = []
+        if self.get_state is not None:
+            self.state = self.get_state()
+        # the state is replaced at once, so that it always matches the file
+        with open(self.state_path + ".tmp", "w") as outputfile:
+            json.dump({"rows": self.rows, "offset": self.offset, "state": self.state}, outputfile)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def removing_state(self):
+        """
+        Removes the state file, once the file is written completely and nothing
+        is left to resume.
+        """
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def close(self):
+        """
+        Writes the rows left in the buffer and closes the file.
+        """
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if kind is None:
+            self.close()
+        else:
+            # the walk was stopped during a step, after the random generator
+            # was used for the next position: the buffer is dropped, so that the
+            # file and the state saved stay those of the last chunk written
+            self.file.close()
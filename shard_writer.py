@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+## This module writes the rendered frames and their labels in tar shards of a
+## fixed number of frames, in the layout of WebDataset: every frame is stored as
+## <key>.png followed by its label <key>.json. Every shard finished has an index
+## file with the offsets of its members, so that it can be read sequentially by
+## a training job or at random by dataset_reader.py.
+
+import glob, io, json, os, tarfile, time
+
+
+class ShardWriter():
+    """
+    This class appends the frames to the shard being written, named
+    <prefix>-<number>.tar.tmp, and renames it <prefix>-<number>.tar once it holds
+    max_count frames (or max_bytes bytes), next to its index <prefix>-<number>.json.
+    The shards finished by an interrupted job are kept: a new writer goes on with
+    the next shard number, and the keys already written can be skipped.
+
+    The renderers name the frames of the shards frame_{:08d} (frame_00000042),
+    padded so that the keys sort in the order of the frames, whereas the frames
+    of the zip archives keep the names frame_{} (frame_42.png) of
+    generate_database.py. The label of a frame holds the scale as a float, and
+    the stl file as its name without extension.
+    """
+
+    def __init__(self, folder, prefix, max_count=1000, max_bytes=None):
+        """
+        folder: folder of the shards
+        prefix: beginning of the names of the shards
+        max_count: greatest number of frames in a shard
+        max_bytes: greatest size of a shard, None for no limit
+        """
+        self.folder = folder
+        self.prefix = prefix
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok=True)
+        # the shards not finished are removed, the others are kept
+        for partial in glob.glob(os.path.join(folder, prefix + "-*.tar.tmp")):
+            os.remove(partial)
+        self.indexes = sorted(glob.glob(os.path.join(folder, prefix + "-*.json")))
+        self.number = len(self.indexes)
+        self.tar, self.members = None, []
+
+    def written_keys(self):
+        """
+        Returns the set of the keys of the frames of the shards finished.
+        """
+        keys = set()
+        for index in self.indexes:
+            with open(index) as inputfile:
+                keys.update(member["key"] for member in json.load(inputfile)["members"])
+        return keys
+
+    def shard_path(self):
+        """
+        Returns the path of the shard being written, without its extension.
+        """
+        return os.path.join(self.folder, "{}-{:06d}".format(self.prefix, self.number))
+
+    def adding(self, name, data):
+        """
+        Adds a file to the shard being written and returns the offset of its data.
+        """
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        self.tar.addfile(info, io.BytesIO(data))
+        # the data is followed by padding up to a block of 512 bytes
+        return self.tar.offset - (len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+
+    def write(self, key, image, label):
+        """
+        Appends a frame and its label to the shard being written.
+
+        key: name of the frame, without extension
+        image: bytes of the png file
+        label: dictionary saved as json with the frame
+        """
+        if self.tar is None:
+            self.tar = tarfile.open(self.shard_path() + ".tar.tmp", "w", format=tarfile.USTAR_FORMAT)
+        data = json.dumps(label).encode()
+        member = {"key": key, "label": label}
+        member["png_offset"], member["png_size"] = self.adding(key + ".png", image), len(image)
+        member["json_offset"], member["json_size"] = self.adding(key + ".json", data), len(data)
+        self.members.append(member)
+        if len(self.members) >= self.max_count or (
+                self.max_bytes is not None and self.tar.offset >= self.max_bytes):
+            self.finishing()
+
+    def finishing(self):
+        """
+        Closes the shard being written, renames it and writes its index.
+        """
+        if self.tar is None:
+            return
+        self.tar.close()
+        path = self.shard_path()
+        os.replace(path + ".tar.tmp", path + ".tar")
+        with open(path + ".json.tmp", "w") as outputfile:
+            json.dump({"shard": os.path.basename(path) + ".tar", "members": self.members}, outputfile)
+        os.replace(path + ".json.tmp", path + ".json")
+        self.indexes.append(path + ".json")
+        self.number += 1
+        self.tar, self.members = None, []
+
+    def close(self):
+        """
+        Finishes the last shard.
+        """
+        self.finishing()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
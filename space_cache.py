@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+## This module keeps the spaces of quaternions created by creating_space.py in a
+## folder, under the name of their generator, their seed and their size, so that
+## they are loaded as memmaps instead of being created again. A space of the
+## cache can be grown: the points already created are kept and only the new
+## ones are created, instead of creating the bigger space from scratch.
+
+import glob, json, os
+import numpy as np
+from creating_space import Space
+
+# odd factors mixing the bits of the four components in the key of a quaternion
+HASH_FACTORS = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F,
+                         0x165667B19E3779F9, 0xD6E8FEB86659FD93], dtype=np.uint64)
+
+
+def hashing_rows(rows):
+    """
+    Returns a key of 64 bits for every quaternion of an array of shape (n, 4),
+    computed from the bits of its components, so that equal quaternions have
+    the same key.
+    """
+    bits = np.ascontiguousarray(rows, dtype=float).view(np.uint64)
+    # the products and the sum are computed modulo 2**64
+    return (bits * HASH_FACTORS).sum(axis=1, dtype=np.uint64)
+
+
+class SpaceCache():
+    """
+    This class saves every space in <generator>_<seed>_<size>.npy, next to a
+    json file holding its parameters and, for the random spaces, the state of
+    the generator after the last draw with the sorted keys of the points in
+    <generator>_<seed>_<size>.keys.npy. The points of a halton space are the
+    first points of a bigger one, and so are the points of a random space, whose
+    quaternions are drawn by blocks of a fixed size: it is grown by drawing the
+    new points from the state saved, and holds the same points whether it was
+    grown or created at once. A super-Fibonacci spiral depends on its size, so
+    it is created again for every size.
+    """
+
+    growable = ("random", "halton")
+
+    def __init__(self, folder):
+        """
+        folder: folder of the spaces
+        """
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        # sorted keys of the points of the random spaces loaded, used to reject
+        # the duplicates when they are grown
+        self.keys = {}
+
+    def normalizing(self, generator, seed):
+        """
+        Returns the seed under which a space is saved: the spaces which are not
+        random do not depend on it.
+        """
+        if generator != "random":
+            return None
+        if seed is None:
+            raise ValueError("a random space can only be cached with a seed")
+        return seed
+
+    def path(self, generator, seed, size):
+        """
+        Returns the path of the .npy file of a space.
+        """
+        return os.path.join(self.folder, "{}_{}_{}.npy".format(generator, seed, size))
+
+    def metadata(self, path):
+        """
+        Returns the parameters saved with the space of path.
+        """
+        with open(os.path.splitext(path)[0] + ".json") as inputfile:
+            return json.load(inputfile)
+
+    def sizes(self, generator, seed):
+        """
+        Returns the sizes of the spaces of a generator and a seed in the cache.
+        """
+        prefix = "{}_{}_".format(generator, seed)
+        return sorted(int(os.path.basename(path)[len(prefix):-len(".json")])
+                      for path in glob.glob(os.path.join(self.folder, prefix + "*.json")))
+
+    def keys_path(self, path):
+        """
+        Returns the path of the sorted keys of the points of the space of path.
+        """
+        return os.path.splitext(path)[0] + ".keys.npy"
+
+    def saving(self, path, space_array, metadata, keys=None):
+        """
+        Saves a space, the sorted keys of its points if any and its parameters.
+        The json file is written last, so that a space is only in the cache once
+        it is complete.
+        """
+        np.save(path + ".tmp.npy", space_array)
+        os.replace(path + ".tmp.npy", path)
+        if keys is not None:
+            np.save(path + ".keys.tmp.npy", keys)
+            os.replace(path + ".keys.tmp.npy", self.keys_path(path))
+        metapath = os.path.splitext(path)[0] + ".json"
+        with open(metapath + ".tmp", "w") as outputfile:
+            json.dump(metadata, outputfile)
+        os.replace(metapath + ".tmp", metapath)
+
+    def load(self, generator="random", seed=None, size=1000):
+        """
+        Returns the space of a generator, a seed and a size as a read-only
+        memmap. If it is not in the cache, it is grown from the biggest smaller
+        space of the same generator and seed, or created, then saved.
+
+        generator: name of the generator given to Space.create_space()
+        seed: seed of the random generator
+        size: number of quaternions of the space
+        """
+        seed = self.normalizing(generator, seed)
+        path = self.path(generator, seed, size)
+        if self.sizes(generator, seed).count(size):
+            return np.load(path, mmap_mode="r")
+        # the random spaces saved with the state of the generator of the former
+        # draws, which were not by blocks, are not grown
+        smaller = [cached for cached in self.sizes(generator, seed) if cached < size
+                   and (generator != "random"
+                        or "drawing_state" in self.metadata(self.path(generator, seed, cached)))]
+        if smaller and generator in self.growable:
+            space_array = np.load(self.path(generator, seed, smaller[-1]), mmap_mode="r")
+            return self.grow(space_array, generator, seed, size)
+        space = Space(size, 0, seed=seed)
+        space_array = space.create_space(generator)
+        metadata = {"generator": generator, "seed": seed, "size": size, "grown_from": None}
+        keys = None
+        if generator == "random":
+            metadata["drawing_state"] = space.drawing_state()
+            keys = self.keys[path] = np.sort(hashing_rows(space_array))
+        self.saving(path, space_array, metadata, keys)
+        return np.load(path, mmap_mode="r")
+
+    def grow(self, space_array, generator, seed, size, index=None):
+        """
+        Returns a space of size quaternions whose first points are the ones of a
+        space of the cache, as a read-only memmap, and saves it. Only the new
+        points are created, and they are added to the index of the space if any.
+
+        space_array: space of the cache of the same generator and seed
+        generator: "random" or "halton"
+        seed: seed of the random generator
+        size: number of quaternions of the space grown
+        index: QuaternionIndex built on space_array, to which the new points are added
+        """
+        seed = self.normalizing(generator, seed)
+        if generator not in self.growable:
+            raise ValueError("a {} space can not be grown".format(generator))
+        previous = len(space_array)
+        if size < previous:
+            raise ValueError("a space of {} quaternions can not be grown to {}".format(previous, size))
+        previous_path = self.path(generator, seed, previous)
+        metadata = self.metadata(previous_path)
+        if generator == "halton":
+            new = Space(size - previous, 0).create_space_halton(start=previous)
+            keys = None
+        else:
+            space = Space(size, 0, seed=seed)
+            space.restoring_drawing(metadata["drawing_state"])
+            keys = self.keys.pop(previous_path, None)
+            if keys is None and os.path.exists(self.keys_path(previous_path)):
+                keys = np.load(self.keys_path(previous_path))
+            elif keys is None:
+                keys = np.sort(hashing_rows(space_array))
+            new = np.empty((0, 4))
+            while len(new) < size - previous:
+                rows = space.creating_quaternions_array(size - previous - len(new))
+                rows_keys = hashing_rows(rows)
+                # the points drawn twice, or whose key is already in the space,
+                # are dropped and the next ones are drawn, as create_space_array()
+                # does (a collision of keys only costs a draw)
+                _, first = np.unique(rows_keys, return_index=True)
+                rows, rows_keys = rows[np.sort(first)], rows_keys[np.sort(first)]
+                if len(keys):
+                    found = keys[np.minimum(np.searchsorted(keys, rows_keys), len(keys) - 1)]
+                    rows, rows_keys = rows[found != rows_keys], rows_keys[found != rows_keys]
+                new = np.concatenate([new, rows])
+                rows_keys = np.sort(rows_keys)
+                keys = np.insert(keys, np.searchsorted(keys, rows_keys), rows_keys)
+            metadata["drawing_state"] = space.drawing_state()
+        path = self.path(generator, seed, size)
+        metadata.update({"size": size, "grown_from": previous})
+        self.saving(path, np.concatenate([space_array, new]), metadata, keys)
+        if generator == "random":
+            self.keys[path] = keys
+        if index is not None:
+            index.add(new)
+        return np.load(path, mmap_mode="r")
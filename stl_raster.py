@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+## This module reads the stl files and renders them with numpy only, without
+## Blender: the mesh is placed as addingstl() does in generate_database.py, and
+## seen by the orthographic camera of addingcamera(). For a batch of
+## quaternions, it renders the silhouette, the depth and the shading of the
+## faces lit from the camera, so that previews (and references to check the
+## images of Blender) can be made on nodes without GPU nor display.
+##
+##     python stl_raster.py --stl stl/cube.stl --scale 1 --start 0 --stop 100 \
+##         --rotations rotations_csv.csv --output dataset
+##
+## takes the same arguments as stub_renderer.py, so that render_scheduler.py can
+## run it on the units of the database (--raster).
+
+import os, struct
+import numpy as np
+from quaternion_kernels import rotation_matrices
+from render_scheduler import running_unit, unit_parser
+
+# settings of the camera of generate_database.py, and image rendered, part of
+# the key of the images in the render cache
+RASTER_SETTINGS = {"renderer": "raster", "resolution": 128, "ortho_scale": 40,
+                   "distance_camera_target": 100, "image": "shading"}
+
+# record of a triangle of a binary stl file
+STL_RECORD = np.dtype([("normal", "<f4", 3), ("vertices", "<f4", (3, 3)), ("attribute", "<u2")])
+
+
+def reading_stl(filepath):
+    """
+    Returns the triangles of a binary or ascii stl file, as an array of shape
+    (n, 3, 3) of the coordinates of their vertices.
+    """
+    with open(filepath, "rb") as inputfile:
+        data = inputfile.read()
+    if len(data) >= 84:
+        count = struct.unpack("<I", data[80:84])[0]
+        # binary files can also begin with "solid", so they are recognized by
+        # their size
+        if len(data) == 84 + count * STL_RECORD.itemsize:
+            return np.frombuffer(data, STL_RECORD, count, offset=84)["vertices"].astype(float)
+    values = [line.split()[1:4] for line in data.decode("ascii", "replace").splitlines()
+              if line.strip().startswith("vertex")]
+    return np.array(values, dtype=float).reshape(-1, 3, 3)
+
+
+def silhouette_iou(first, second):
+    """
+    Returns the intersection over union of the silhouettes of two images, the
+    pixels of an object being the pixels which are not black, to compare an
+    image of the rasterizer with the one of Blender.
+    """
+    first, second = np.asarray(first) > 0, np.asarray(second) > 0
+    if first.ndim == 3:
+        first = first.any(axis=-1)
+    if second.ndim == 3:
+        second = second.any(axis=-1)
+    union = np.count_nonzero(first | second)
+    return np.count_nonzero(first & second) / union if union else 1.
+
+
+class StlMesh():
+    """
+    This class holds the vertices of an stl file, each stored once, and the
+    faces as triples of numbers of vertices. The mesh is placed as addingstl()
+    does: its origin is the center of its bounds, or the median of its
+    vertices for the tore, which is also scaled by 0.7.
+    """
+
+    def __init__(self, filepath):
+        """
+        filepath: path of the stl file
+        """
+        self.filepath = filepath
+        triangles = reading_stl(filepath)
+        self.vertices, faces = np.unique(triangles.reshape(-1, 3), axis=0, return_inverse=True)
+        self.faces = faces.reshape(-1, 3)
+        lower, upper = self.bounds()
+        if os.path.basename(filepath) == "tore_parallelogramme_360.stl":
+            self.origin, self.scale = self.vertices.mean(axis=0), 0.7
+        else:
+            self.origin, self.scale = (lower + upper) / 2, 1.
+
+    def bounds(self):
+        """
+        Returns the lowest and the highest coordinates of the vertices.
+        """
+        return self.vertices.min(axis=0), self.vertices.max(axis=0)
+
+    def dimensions(self):
+        """
+        Returns the dimensions of the mesh on the x, y and z axis, as the
+        dimensions of the object in Blender.
+        """
+        lower, upper = self.bounds()
+        return (upper - lower) * self.scale
+
+    def placed(self):
+        """
+        Returns the vertices around the origin of the scene, before the rotation.
+        """
+        return (self.vertices - self.origin) * self.scale
+
+
+class MeshRasterizer():
+    """
+    This class renders a mesh rotated by quaternions, seen by the camera of
+    generate_database.py: an orthographic camera at (distance, 0, 0) looking
+    toward -x, whose right is -y and whose top is -z. Every triangle is tested
+    on the pixels of its bounding box, and the triangle nearest to the camera
+    is kept for every pixel with a z-buffer, for a whole batch of quaternions
+    at once.
+    """
+
+    def __init__(self, mesh, resolution=128, ortho_scale=40, distance=100):
+        """
+        mesh: StlMesh rendered
+        resolution: width and height of the images
+        ortho_scale: width of the scene seen by the camera
+        distance: distance between the camera and the origin of the scene
+        """
+        self.mesh = mesh
+        self.resolution = resolution
+        self.ortho_scale = ortho_scale
+        self.distance = distance
+        self.vertices = mesh.placed()
+
+    def projecting(self, quaternions):
+        """
+        Returns the coordinates of the vertices in the image (columns and rows,
+        the centers of the pixels being integers) and their distance to the
+        camera, as arrays of shape (batch, vertices), with the vertices rotated.
+        """
+        rotated = np.einsum("bij,vj->bvi", rotation_matrices(quaternions), self.vertices)
+        pixels = self.resolution / self.ortho_scale
+        columns = (self.ortho_scale / 2 - rotated[..., 1]) * pixels - 0.5
+        rows = (self.ortho_scale / 2 + rotated[..., 2]) * pixels - 0.5
+        return columns, rows, self.distance - rotated[..., 0], rotated
+
+    def render(self, quaternions, batch_size=16):
+        """
+        Returns the depth (the distance to the camera, inf on the background)
+        and the shading (the cosine between the face and the direction of the
+        camera, 0 on the background) of the mesh rotated by every quaternion,
+        as arrays of shape (n, resolution, resolution). The silhouette is
+        depth < inf.
+
+        quaternions: array of shape (n, 4) of quaternions (w,x,y,z)
+        batch_size: number of quaternions rendered at once
+        """
+        quaternions = np.asarray(quaternions, dtype=float).reshape(-1, 4)
+        size = self.resolution * self.resolution
+        depth = np.full(len(quaternions) * size, np.inf)
+        shading = np.zeros(len(quaternions) * size)
+        for first in range(0, len(quaternions), batch_size):
+            batch = quaternions[first:first + batch_size]
+            pixels, depths, shades = self.rasterizing(batch)
+            pixels += first * size
+            depth[pixels], shading[pixels] = depths, shades
+        shape = (len(quaternions), self.resolution, self.resolution)
+        return depth.reshape(shape), shading.reshape(shape)
+
+    def rasterizing(self, quaternions):
+        """
+        Returns the pixels covered by the mesh for a batch of quaternions (as
+        numbers of pixels in the images of the batch put one after the other),
+        with the depth and the shading of the nearest triangle on each of them.
+        """
+        columns, rows, distances, rotated = self.projecting(quaternions)
+        faces = self.mesh.faces
+        # coordinates of the vertices of every triangle, of shape (batch, faces, 3)
+        x, y, d = columns[:, faces], rows[:, faces], distances[:, faces]
+        # the faces are lit from the camera, whatever their orientation
+        corners = rotated[:, faces]
+        normals = np.cross(corners[:, :, 1] - corners[:, :, 0], corners[:, :, 2] - corners[:, :, 0])
+        lengths = np.linalg.norm(normals, axis=-1)
+        shades = np.abs(normals[..., 0]) / np.where(lengths > 0, lengths, 1)
+        area = ((x[..., 1] - x[..., 0]) * (y[..., 2] - y[..., 0])
+                - (x[..., 2] - x[..., 0]) * (y[..., 1] - y[..., 0]))
+        # bounding boxes of the triangles, in the image
+        last = self.resolution - 1
+        left = np.clip(np.ceil(x.min(axis=-1)), 0, last + 1).astype(int)
+        right = np.clip(np.floor(x.max(axis=-1)), -1, last).astype(int)
+        top = np.clip(np.ceil(y.min(axis=-1)), 0, last + 1).astype(int)
+        bottom = np.clip(np.floor(y.max(axis=-1)), -1, last).astype(int)
+        widths = np.maximum(right - left + 1, 0)
+        counts = (widths * np.maximum(bottom - top + 1, 0)).ravel()
+        counts[area.ravel() == 0] = 0
+        # one candidate for every pixel of the bounding box of every triangle
+        triangles = np.repeat(np.arange(len(counts)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        px = left.ravel()[triangles] + offsets % widths.ravel()[triangles]
+        py = top.ravel()[triangles] + offsets // widths.ravel()[triangles]
+        x, y, d = x.reshape(-1, 3)[triangles], y.reshape(-1, 3)[triangles], d.reshape(-1, 3)[triangles]
+        area = area.ravel()[triangles]
+        # barycentric coordinates of the centers of the pixels
+        l0 = ((x[:, 1] - px) * (y[:, 2] - py) - (x[:, 2] - px) * (y[:, 1] - py)) / area
+        l1 = ((x[:, 2] - px) * (y[:, 0] - py) - (x[:, 0] - px) * (y[:, 2] - py)) / area
+        l2 = 1 - l0 - l1
+        inside = (l0 >= 0) & (l1 >= 0) & (l2 >= 0)
+        depths = (l0 * d[:, 0] + l1 * d[:, 1] + l2 * d[:, 2])[inside]
+        frames = triangles[inside] // len(faces)
+        pixels = (frames * self.resolution + py[inside]) * self.resolution + px[inside]
+        # z-buffer: the candidates are sorted by pixel then by depth, and the
+        # first one of every pixel is kept
+        order = np.lexsort((depths, pixels))
+        pixels, depths = pixels[order], depths[order]
+        nearest = np.ones(len(pixels), dtype=bool)
+        nearest[1:] = pixels[1:] != pixels[:-1]
+        return (pixels[nearest], depths[nearest],
+                shades.ravel()[triangles[inside][order][nearest]])
+
+    def images(self, quaternions, mode="shading", batch_size=16):
+        """
+        Returns the images of the mesh rotated by every quaternion, as an array
+        of uint8 of shape (n, resolution, resolution) with a black background.
+
+        quaternions: array of shape (n, 4) of quaternions (w,x,y,z)
+        mode: "silhouette" (white object), "depth" (the nearest points being
+        the brightest) or "shading"
+        batch_size: number of quaternions rendered at once
+        """
+        depth, shading = self.render(quaternions, batch_size)
+        if mode == "silhouette":
+            values = np.isfinite(depth).astype(float)
+        elif mode == "depth":
+            # the depths of the scene seen by the camera go from distance - ortho_scale / 2
+            # to distance + ortho_scale / 2
+            near = self.distance - self.ortho_scale / 2
+            values = np.where(np.isfinite(depth), 1 - (depth - near) / self.ortho_scale, 0)
+        elif mode == "shading":
+            values = shading
+        else:
+            raise ValueError("unknown mode {}".format(mode))
+        return np.round(np.clip(values, 0, 1) * 255).astype(np.uint8)
+
+
+def main(argv=None):
+    """
+    Renders the frames of the unit given on the command line, and writes their
+    labels unless the frames are written in shards.
+
+    argv: arguments of the command line, sys.argv[1:] by default
+    """
+    parser = unit_parser("Renders the images of a unit without Blender")
+    parser.add_argument("--mode", default="shading", choices=["silhouette", "depth", "shading"])
+    parser.add_argument("--batch-size", type=int, default=16)
+    args = parser.parse_args(argv)
+    settings = dict(RASTER_SETTINGS, image=args.mode)
+    mesh = StlMesh(args.stl)
+    rasterizer = MeshRasterizer(mesh, settings["resolution"], settings["ortho_scale"],
+                                settings["distance_camera_target"])
+    running_unit(args, settings,
+                 lambda quaternions: rasterizer.images(quaternions, args.mode, args.batch_size),
+                 mesh.dimensions().tolist(), args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+## This script takes the place of Blender for the units of render_scheduler.py:
+## it writes a black png for every frame of the unit and the labels of these
+## frames, with the same names as generate_database.py, so that the scheduler
+## and the render cache can be checked without Blender.
+
+import numpy as np
+from render_scheduler import running_unit, unit_parser
+
+# settings of the stub, part of the key of the images in the render cache
+STUB_SETTINGS = {"renderer": "stub", "resolution": 128}
+
+
+def black_images(quaternions, size=128):
+    """
+    Returns a black image of size*size pixels for every quaternion.
+    """
+    return np.zeros((len(quaternions), size, size), dtype=np.uint8)
+
+
+def main(argv=None):
+    """
+    Writes a black png for every frame of the unit given on the command line,
+    and its labels unless the frames are written in shards.
+
+    argv: arguments of the command line, sys.argv[1:] by default
+    """
+    args = unit_parser("Renders dummy images for a unit").parse_args(argv)
+    running_unit(args, STUB_SETTINGS, black_images, [1.0, 1.0, 1.0], batch_size=64)
+
+
+if __name__ == '__main__':
+    main()
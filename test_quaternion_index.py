@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+## This script checks that the walks, the tours and the nearest quaternions
+## found with a QuaternionIndex are the same as the ones found by scoring the
+## whole space, including after quaternions were removed from the index or
+## added to it.
+##
+##     python -m unittest test_quaternion_index
+
+import unittest
+import numpy as np
+from creating_space import Space
+from quaternion_index import QuaternionIndex
+
+
+def walk_positions(space_array, steps, index=None, seed=1, neighbour=10):
+    """
+    Returns the positions of a seeded walk as an array of shape (steps, 4).
+    """
+    space = Space(len(space_array), neighbour, seed=seed)
+    return np.array([q for _, q, _ in space.walking(space_array, steps, index)])
+
+
+def tour_positions(space_array, index=None, seed=1, neighbour=10):
+    """
+    Returns the positions of a seeded tour as an array of shape (n, 4).
+    """
+    space = Space(len(space_array), neighbour, seed=seed)
+    return np.array([q for _, q, _ in space.touring(space_array, index)])
+
+
+class QuaternionIndexTest(unittest.TestCase):
+    """
+    Compares the index with the scan of the whole space on seeded spaces.
+    """
+
+    def setUp(self):
+        self.space_array = Space(3000, 0, seed=3).create_space()
+        self.extra = Space(1000, 0, seed=7).create_space()
+
+    def test_walk(self):
+        np.testing.assert_array_equal(
+            walk_positions(self.space_array, 1500, QuaternionIndex(self.space_array)),
+            walk_positions(self.space_array, 1500))
+
+    def test_query(self):
+        space = Space(len(self.space_array), 10, seed=1)
+        index = QuaternionIndex(self.space_array)
+        q_now, transf_prec = self.space_array[0], self.space_array[1]
+        distances = space.scoring_quaternions(q_now, self.space_array, transf_prec)
+        distances[0] = np.inf
+        candidates, scores = index.query(space, q_now, transf_prec, 10, exclude=0)
+        np.testing.assert_array_equal(np.sort(candidates), np.sort(np.argsort(distances)[:10]))
+        np.testing.assert_allclose(np.sort(scores), np.sort(distances)[:10])
+
+    def test_nearest(self):
+        # probes near w = 0 check that q and -q are the same rotation
+        probes = np.concatenate([self.extra, self.extra[:200] * [1e-3, 1, 1, 1]])
+        probes /= np.linalg.norm(probes, axis=1)[:, np.newaxis]
+        index = QuaternionIndex(self.space_array)
+        for removed in (None, np.arange(0, len(self.space_array), 3)):
+            alive = np.ones(len(self.space_array), dtype=bool)
+            if removed is not None:
+                for i in removed:
+                    index.remove(i)
+                alive[removed] = False
+            for points, exclude in ((probes, None),
+                                    (self.space_array, np.arange(len(self.space_array)))):
+                distances = np.sqrt(np.maximum(2 - 2 * np.abs(points @ self.space_array.T), 0))
+                distances[:, ~alive] = np.inf
+                if exclude is not None:
+                    distances[np.arange(len(points)), exclude] = np.inf
+                indexes, found = index.nearest(points, exclude)
+                np.testing.assert_array_equal(indexes, distances.argmin(axis=1))
+                np.testing.assert_allclose(found, distances.min(axis=1), atol=1e-7)
+
+    def test_tour_after_remove(self):
+        # the tour removes every quaternion visited from the index
+        np.testing.assert_array_equal(
+            tour_positions(self.space_array, QuaternionIndex(self.space_array)),
+            tour_positions(self.space_array))
+
+    def test_remove_and_restore(self):
+        index = QuaternionIndex(self.space_array)
+        index.remove(5)
+        index.remove(1200)
+        index.restore(5)
+        index.restore(1200)
+        np.testing.assert_array_equal(walk_positions(self.space_array, 500, index),
+                                      walk_positions(self.space_array, 500))
+
+    def test_add(self):
+        full = np.concatenate([self.space_array, self.extra])
+        index = QuaternionIndex(self.space_array)
+        for rows in np.array_split(self.extra, 3):
+            index.add(rows)
+        np.testing.assert_array_equal(index.space_array, full)
+        np.testing.assert_array_equal(walk_positions(full, 1500, index), walk_positions(full, 1500))
+
+    def test_tour_after_add(self):
+        full = np.concatenate([self.space_array, self.extra])
+        index = QuaternionIndex(self.space_array)
+        index.add(self.extra)
+        np.testing.assert_array_equal(tour_positions(full, index), tour_positions(full))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+## This script checks the hits and the misses of the RenderCache, and that the
+## images used the least recently are removed once the cache is bigger than
+## max_bytes.
+##
+##     python -m unittest test_render_cache
+
+import os, shutil, tempfile, unittest
+from render_cache import RenderCache
+
+
+class RenderCacheTest(unittest.TestCase):
+    """
+    Stores images of 100 bytes in a cache holding at most three of them.
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.stl = os.path.join(self.folder, "cube.stl")
+        with open(self.stl, "wb") as outputfile:
+            outputfile.write(b"solid cube")
+        self.cache = RenderCache(os.path.join(self.folder, "cache"), max_bytes=300)
+        self.keys = [self.cache.key(self.stl, 1, {"resolution": 128}, [1, 0, 0, i / 10])
+                     for i in range(5)]
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def image(self, i):
+        """
+        Writes the image number i and returns its path.
+        """
+        path = os.path.join(self.folder, "image_{}.png".format(i))
+        with open(path, "wb") as outputfile:
+            outputfile.write(bytes([i]) * 100)
+        return path
+
+    def test_key(self):
+        # q and -q are the same rotation, and the rounding errors do not change the key
+        self.assertEqual(self.cache.key(self.stl, 1, {"resolution": 128}, [0.6, 0, 0, 0.8]),
+                         self.cache.key(self.stl, 1, {"resolution": 128}, [-0.6, 0, 0, -0.8 + 1e-9]))
+        self.assertNotEqual(self.cache.key(self.stl, 1, {"resolution": 128}, [0.6, 0, 0, 0.8]),
+                            self.cache.key(self.stl, 0.8, {"resolution": 128}, [0.6, 0, 0, 0.8]))
+
+    def test_hits_and_misses(self):
+        destination = os.path.join(self.folder, "frame.png")
+        self.assertFalse(self.cache.get(self.keys[0], destination))
+        self.cache.put(self.keys[0], self.image(0))
+        self.assertTrue(self.cache.get(self.keys[0], destination))
+        with open(destination, "rb") as inputfile:
+            self.assertEqual(inputfile.read(), bytes([0]) * 100)
+        self.assertFalse(self.cache.get(self.keys[1], destination))
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"]), (1, 2, 0))
+        self.assertEqual((stats["entries"], stats["bytes"]), (1, 100))
+
+    def test_eviction(self):
+        destination = os.path.join(self.folder, "frame.png")
+        for i in range(3):
+            self.cache.put(self.keys[i], self.image(i))
+        # the first image becomes the one used the most recently
+        self.assertTrue(self.cache.get(self.keys[0], destination))
+        self.cache.put(self.keys[3], self.image(3))
+        self.cache.put(self.keys[4], self.image(4))
+        self.assertEqual(self.cache.stats()["evictions"], 2)
+        self.assertEqual(self.cache.size, 300)
+        self.assertEqual(sorted(os.listdir(self.cache.folder)),
+                         sorted(key + ".png" for key in (self.keys[0], self.keys[3], self.keys[4])))
+        for i, found in enumerate([True, False, False, True, True]):
+            self.assertEqual(self.cache.get(self.keys[i], destination), found)
+        # a new cache on the same folder finds the images kept
+        self.assertEqual(len(RenderCache(self.cache.folder, max_bytes=300).entries), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
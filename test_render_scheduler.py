@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+## This script checks that a RenderScheduler killed while it runs its units
+## resumes from the manifest: the rerun only renders the units which were not
+## finished, and the archives hold every frame with the merged labels. The
+## units are rendered by stub_renderer.py, so Blender is not needed.
+##
+##     python -m unittest test_render_scheduler
+
+import json, os, shutil, signal, subprocess, sys, tempfile, time, unittest, zipfile
+import numpy as np
+from rotations_io import load_rotations, save_rotations
+from render_scheduler import RenderScheduler, stl_name, stl_scales
+
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+class RenderSchedulerTest(unittest.TestCase):
+    """
+    Kills a scheduler run by its command line, then runs it again.
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.stl = os.path.join(self.folder, "stl")
+        os.makedirs(self.stl)
+        shutil.copy(os.path.join(FOLDER, "stl", "cube.stl"), self.stl)
+        self.rotations = os.path.join(self.folder, "rotations.csv")
+        quaternions = np.random.default_rng(1).normal(size=(12, 4))
+        quaternions /= np.linalg.norm(quaternions, axis=1)[:, np.newaxis]
+        save_rotations(self.rotations, list(quaternions))
+        self.output = os.path.join(self.folder, "dataset")
+        self.command = [sys.executable, os.path.join(FOLDER, "stub_renderer.py")]
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_resume_after_kill(self):
+        manifest = os.path.join(self.output, "render_manifest.jsonl")
+        # the scheduler and its renderers are killed together, once a few units
+        # are recorded in the manifest
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(FOLDER, "render_scheduler.py"), "--stub",
+             "--stl", self.stl, "--rotations", self.rotations, "--output", self.output,
+             "--frames-per-unit", "2", "--workers", "1"],
+            cwd=FOLDER, stdout=subprocess.DEVNULL, start_new_session=True)
+        try:
+            while process.poll() is None:
+                if os.path.exists(manifest):
+                    with open(manifest) as inputfile:
+                        if len(inputfile.readlines()) >= 3:
+                            break
+                time.sleep(0.01)
+        finally:
+            if process.poll() is None:
+                os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+        # a line cut by a kill is ignored, and ended before the next unit recorded
+        with open(manifest, "a") as outputfile:
+            outputfile.write('{"unit": ["')
+
+        scheduler = RenderScheduler([os.path.join(self.stl, "cube.stl")], self.rotations,
+                                    self.output, self.command, frames_per_unit=2, workers=2)
+        units = scheduler.units()
+        done = scheduler.finished()
+        self.assertTrue(0 < len(done & set(units)) < len(units))
+        rendered = []
+        rendering = scheduler.rendering
+        scheduler.rendering = lambda unit: rendered.append(unit) or rendering(unit)
+        self.assertEqual(scheduler.run(), len(units) - len(done & set(units)))
+        self.assertEqual(sorted(rendered), sorted(set(units) - done))
+
+        rotations = load_rotations(self.rotations)
+        for scale in stl_scales("cube.stl"):
+            name = stl_name("cube.stl", scale)
+            self.assertFalse(os.path.exists(os.path.join(self.output, name)))
+            with zipfile.ZipFile(os.path.join(self.output, name + ".zip")) as archive:
+                frames = {"frame_{}.png".format(i) for i in range(len(rotations))}
+                labels = name + "_directory_labels.csv"
+                self.assertEqual(set(archive.namelist()), frames | {labels})
+                lines = archive.read(labels).decode().splitlines()
+            self.assertEqual(lines[:3], ["dimension_x,dimension_y,dimension_z", "1.0,1.0,1.0",
+                                         "number_image,transformation applied from precedent image"])
+            self.assertEqual(len(lines), 3 + len(rotations))
+            for i, line in enumerate(lines[3:]):
+                number, rotation = line.split(",", 1)
+                self.assertEqual(int(number), i)
+                np.testing.assert_allclose(json.loads(rotation.strip('"')), rotations[i, :4])
+        # every unit and every archive is recorded once more, and nothing is left to run
+        self.assertEqual(scheduler.run(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
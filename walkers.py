@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+## This script runs many independent walks through spaces of quaternions on a
+## pool of processes. Every walk gets its own generator derived from one seed,
+## so that the whole set of rotation sequences can be generated again.
+
+import argparse, json, os, time
+import concurrent.futures
+import numpy as np
+from creating_space import Space
+from quaternion_index import QuaternionIndex
+
+
+def seed_record(seed):
+    """
+    Returns what is needed to create again a numpy SeedSequence.
+    """
+    return {"entropy": seed.entropy, "spawn_key": list(seed.spawn_key)}
+
+
+def walking(task):
+    """
+    Runs one walk in a worker process and returns its record for the manifest.
+    The space is opened as a memmap, so that it is shared by every worker
+    instead of being copied in each of them.
+
+    task: dictionary with the job, its seed, the path of the space and the output path
+    """
+    tic = time.time()
+    job = task["job"]
+    space = Space(job["nb_quaternions"], job["neighbour"], seed=task["seed"])
+    space_array = np.load(task["space_path"], mmap_mode="r")
+    index = QuaternionIndex(space_array) if job.get("use_index") else None
+    record = {"job": job, "seed": seed_record(task["seed"]),
+              "space": task["space_path"], "output": task["output"]}
+    if job.get("mode", "walk") == "tour":
+        record["report"] = space.explore_tour(space_array, index, task["output"])._asdict()
+        record["report"] = {key: float(value) for key, value in record["report"].items()}
+    else:
+        record["positions"] = space.writing_walk(space_array, task["output"], job["steps"], index)
+    record["seconds"] = time.time() - tic
+    return record
+
+
+def run_walks(jobs, output_dir, seed=None, processes=None, resume=False):
+    """
+    Runs every walk of jobs on a pool of processes, writes the positions of each
+    one in its own csv file and a manifest with the seeds and the parameters of
+    every walk. Returns the manifest.
+
+    jobs: list of dictionaries with the keys nb_quaternions, neighbour, steps
+    and optionally mode ('walk' or 'tour') and use_index
+    output_dir: folder of the spaces, the walks and the manifest
+    seed: seed from which the seeds of every space and walk are derived
+    processes: number of processes, the number of cpus by default
+    resume: if True, the walks written in output_dir by a previous call with the
+    same jobs and seed are continued, otherwise they are written again
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    root = np.random.SeedSequence(seed)
+    # one space is created for every size, and shared by the walks of this size
+    sizes = sorted({job["nb_quaternions"] for job in jobs})
+    space_seeds = dict(zip(sizes, root.spawn(len(sizes))))
+    walk_seeds = root.spawn(len(jobs))
+    space_paths = {}
+    for size in sizes:
+        space_paths[size] = os.path.join(output_dir, "space_{}.npy".format(size))
+        np.save(space_paths[size], Space(size, 0, seed=space_seeds[size]).create_space_array())
+    for i in range(len(jobs)):
+        path = os.path.join(output_dir, "walk_{}.csv".format(i))
+        # writing_walk() continues a walk whose state file exists
+        if not resume and os.path.exists(path + ".state"):
+            os.remove(path + ".state")
+    tasks = [{"job": job, "seed": walk_seed,
+              "space_path": space_paths[job["nb_quaternions"]],
+              "output": os.path.join(output_dir, "walk_{}.csv".format(i))}
+             for i, (job, walk_seed) in enumerate(zip(jobs, walk_seeds))]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        walks = list(executor.map(walking, tasks))
+    manifest = {"seed": seed_record(root),
+                "spaces": {str(size): {"path": space_paths[size],
+                                       "seed": seed_record(space_seeds[size])}
+                           for size in sizes},
+                "walks": walks}
+    with open(os.path.join(output_dir, "manifest.json"), "w") as outputfile:
+        json.dump(manifest, outputfile, indent=2)
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs walks through spaces of quaternions in parallel")
+    parser.add_argument("jobs", help="json file with the list of walks to run")
+    parser.add_argument("--output", default="walks", help="folder of the walks and the manifest")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the whole set of walks")
+    parser.add_argument("--processes", type=int, default=None, help="number of processes")
+    parser.add_argument("--resume", action="store_true",
+                        help="continues the walks of a previous run with the same jobs and seed")
+    args = parser.parse_args()
+    with open(args.jobs) as inputfile:
+        jobs = json.load(inputfile)
+    run_walks(jobs, args.output, args.seed, args.processes, args.resume)